@@ -1,35 +1,57 @@
 import plot as plt
 import numpy as np
+import profiling
 from scipy.stats import sem
-from data_ingestion import mat_data
-
-TIMELINE = mat_data['time']
+from data_ingestion import mat_data, subject_index, epoch_index, \
+    time_axis, as_timeline
+from cube import range_bounds
+from baseline import PRESTIM_WINDOW, window_slice, check_method
+from features import trapezoid
 
 
 def adjust_python_idx(idx):
     return idx - 1
 
 
+def default_timeline(data=mat_data):
+    """
+
+    @param data: data object
+    @return: the read-only times array of data's Timeline (see time_axis),
+    one array shared by all the Signals instead of copies
+    """
+    return time_axis(data).times
+
+
 class Signal:
 
-    def __init__(self, values, timeline=TIMELINE, noise=None, name=None, group=None):
+    def __init__(self, values, timeline=None, noise=None, name=None, group=None):
         self.values = values
-        self.timeline = timeline
+        self.timeline = default_timeline() if timeline is None else timeline
         self.noise = noise
         self.name = name
         self.group = group
-        self.__gos = self.__init_gos()
+        self.__gos = None   # built on first get_gos, see __init_gos
+
+    @property
+    def nbytes(self):
+        noise_nbytes = 0 if self.noise is None else self.noise.nbytes
+        return self.values.nbytes + noise_nbytes
 
     def isnull(self):
         if np.all(np.isnan(self.values)):
             return True
 
     def __init_gos(self):
-        gos = plt.go_signal(self.values, self.timeline)
-        if self.noise is not None:
+        # decimated to plt.LOD_POINTS points, see plt.add_lod_trace for
+        # keeping the full resolution
+        timeline, values, noise = plt.decimate(self.timeline, self.values,
+                                               self.noise)
+        gos = plt.go_signal(values, timeline, n_full=len(self.values))
+        if noise is not None:
             gos.update(error_y=dict(
                 type="data",
-                array=self.noise/2,
+                array=noise/2,
                 visible=True))
         if self.group is not None:
             gos.update(line_color=plt.CMAP[self.group]['line'])
@@ -38,24 +60,31 @@ class Signal:
         return gos
 
 # TODO: gos must has a name for legend
+    @profiling.profiled()
     def get_gos(self, **kwargs):
+        if self.__gos is None:
+            self.__gos = self.__init_gos()
         self.__gos.update(**kwargs)
         return self.__gos
 
     def show(self, **kwargs):
         fig = plt.init_trial(**kwargs)
         fig.add_trace(self.get_gos())
-        fig.show()
+        with profiling.timer('fig.show'):
+            fig.show()
 
 
 class EEGSignal(Signal):
 
-    def __init__(self, name, trial, block, timeline=TIMELINE, data=mat_data):
-        self.sub_id = np.argwhere(data['subjects'] == name).flatten()[0]
+    @profiling.profiled('EEGSignal')
+    def __init__(self, name, trial, block, timeline=None, data=mat_data):
+        self.sub_id = subject_index(data).row(name)
         self.group = data['group'][self.sub_id]
         self.trial = adjust_python_idx(trial)
         self.block = adjust_python_idx(block)
         self.values = data['s2'][self.sub_id, :, self.trial, self.block]
+        if timeline is None:
+            timeline = default_timeline(data)
         super().__init__(values=self.values, timeline=timeline,
                          name=name, group=self.group)
 
@@ -63,15 +92,21 @@ class EEGSignal(Signal):
 # TODO: pass string indicator of trials and blocks to Signal (for plotting)
 class ERPSignal:
 
-    def __init__(self, name, trials, blocks, timeline=TIMELINE, data=mat_data):
+    def __init__(self, name, trials, blocks, timeline=None, data=mat_data):
         self.name = name
-        self.sub_id = np.argwhere(data['subjects'] == name).flatten()[0]
+        self.sub_id = subject_index(data).row(name)
         self.group = data['group'][self.sub_id]
-        self.timeline = timeline
+        self.timeline = default_timeline(data) if timeline is None else timeline
+        self.trials, self.blocks = trials, blocks
+        self.cube = get_cube(data)
         # init trial-block range
         self.trial, self.block, self.trial_start, self.block_start, \
             self.trial_end, self.block_end, self.avg_over = tuple([None] * 7)
         self.data = self.__auto_set_data(trials, blocks, data)
+        self.epochs = epoch_index(data)
+        # number of valid (not all-NaN) epochs averaged
+        self.n_epochs = self.epochs.count(
+            self.sub_id, *trial_block_index(trials, blocks)[:2])
         self.__signal = None
         self.__noise = None
         # self.desc = f"ERPSignal averaged over {self.avg_over}"
@@ -99,25 +134,40 @@ class ERPSignal:
                                 "was passed. Please use EEGSignal.")
             else:
                 self.avg_over = "trial"
-                return data['s2'][self.sub_id, :,
-                       self.trial_start:self.trial_end+1, self.block]
+                key = (self.sub_id, slice(None),
+                       slice(self.trial_start, self.trial_end+1), self.block)
         else:
             if self.trial is not None:
                 self.avg_over = "block"
-                return data['s2'][self.sub_id, :,
-                       self.trial, self.block_start:self.block_end+1]
+                key = (self.sub_id, slice(None),
+                       self.trial, slice(self.block_start, self.block_end+1))
             else:
-                return data['s2'][self.sub_id, :,
-                       self.trial_start:self.trial_end+1,
-                       self.block_start:self.block_end+1]
-
+                key = (self.sub_id, slice(None),
+                       slice(self.trial_start, self.trial_end+1),
+                       slice(self.block_start, self.block_end+1))
+        # fit answers from the cube's sums, s2 is read (e.g dequantized)
+        # only without a cube
+        return None if self.cube is not None else data['s2'][key]
+
+    @profiling.profiled()
     def fit(self):
-        if self.avg_over is None:
-            self.__signal = np.nanmean(self.data, axis=(1, 2))
-            self.__noise = nansem(self.data, axis=(1, 2))
-        else:  # trial or block are both will be on axis=1
-            self.__signal = np.nanmean(self.data, axis=1)
-            self.__noise = np.std(self.data, axis=1)
+        trial, block, avg_over = trial_block_index(self.trials, self.blocks)
+        if self.cube is not None:
+            self.__signal, self.__noise = cube_fit(
+                self.cube, self.sub_id, trial, block, avg_over,
+                n_valid=self.n_epochs)
+        elif self.n_epochs == 0:
+            self.__signal = np.full(self.data.shape[0], np.nan)
+            self.__noise = np.full(self.data.shape[0], np.nan)
+        else:
+            # gather only the valid epochs, (time, valid epochs)
+            epochs = self.data[:, self.epochs.mask(self.sub_id, trial, block)]
+            # accumulate in float64 whatever the storage dtype of s2
+            self.__signal = np.nanmean(epochs, axis=1, dtype=np.float64)
+            if avg_over == "both":
+                self.__noise = nansem(epochs, axis=1)
+            else:  # trial or block
+                self.__noise = np.std(epochs, axis=1, dtype=np.float64)
 
         return Signal(values=self.__signal, timeline=self.timeline,
                       noise=self.__noise, group=self.group)
@@ -125,86 +175,325 @@ class ERPSignal:
 
 class GroupSignal:
 
-    def __init__(self, group, trials, blocks, timeline=TIMELINE, data=mat_data):
-        self.names = data['subjects'][data['group']==group]
+    def __init__(self, group, trials, blocks, timeline=None, data=mat_data):
+        self.rows = subject_index(data).group(group)
+        self.names = data['subjects'][self.rows]
         self.group = group
         self.trials = trials
         self.blocks = blocks
-        self.timeline = timeline
-
+        self.timeline = default_timeline(data) if timeline is None else timeline
+        self.data = data
+        self.cube = get_cube(data)
+        self.epochs = epoch_index(data)
+        # number of valid (not all-NaN) epochs averaged, per subject
+        self.n_epochs = self.epochs.count(
+            self.rows, *trial_block_index(trials, blocks)[:2])
+
+    @profiling.profiled()
     def fit(self):
-        if isinstance(self.trials, int) and isinstance(self.blocks, int):
-            lst_of_vals = [EEGSignal(name, self.trials, self.blocks).values
-                           for name in self.names]
-            sub_vals_arr = np.stack(lst_of_vals, axis=0)
-            # in case of grouping eeg:
-            # noise is set to be the group's average signal
-            noise = nansem(sub_vals_arr, axis=0)
-
+        trial, block, avg_over = trial_block_index(self.trials, self.blocks)
+        if self.cube is not None and avg_over != "none":
+            sub_vals_arr, sub_noise_arr = cube_fit(
+                self.cube, self.rows, trial, block, avg_over,
+                n_valid=self.n_epochs)
         else:
-            lst_of_sigs = [ERPSignal(name, self.trials, self.blocks).fit()
-                       for name in self.names]
-            lst_of_vals = [sig.values for sig in lst_of_sigs]
-            lst_of_noise = [sig.noise for sig in lst_of_sigs]
-            sub_vals_arr = np.stack(lst_of_vals, axis=0)
-            # in case of grouping erp:
-            # noise is set to be the group's average noise
-            sub_noise_arr = np.stack(lst_of_noise, axis=0)
-            noise = np.nanmean(sub_noise_arr, axis=0)
-
-        mean_vals = np.nanmean(sub_vals_arr, axis=0)
+            sub_vals_arr, sub_noise_arr = subject_fits(
+                self.data['s2'], self.rows, trial, block, avg_over,
+                valid=self.epochs.mask(self.rows, trial, block))
+        mean_vals, noise = group_reduce(sub_vals_arr, sub_noise_arr)
 
         return Signal(values=mean_vals, noise=noise,
                       timeline=self.timeline, group=self.group)
 
 
+@profiling.profiled()
+def subject_fits(s2, rows, trial, block, avg_over, valid=None):
+    """
+Per-subject values and noise of a group, as ERPSignal.fit (or EEGSignal,
+for a single epoch) computes them, with one gather for all the rows.
+Subjects without valid epochs in the query are not gathered, they are NaN.
+    @param s2: eeg tensor (subjects, time, trials, blocks)
+    @param rows: int np array of subjects rows
+    @param trial: trial index (int or slice), see trial_block_index
+    @param block: block index (int or slice), see trial_block_index
+    @param avg_over: averaged axes, see trial_block_index
+    @param valid: bool np array of the valid epochs of the query, shaped
+    like s2[rows, 0, trial, block] (see EpochIndex.mask), None to find them
+    in the gathered data
+    @return: (values, noise) of shape (len(rows), time), noise is None for a
+    single epoch
+    """
+    rows = np.asarray(rows)
+    # (subjects, time[, trials][, blocks])
+    if valid is None:
+        with profiling.timer('subject_fits.gather'):
+            sub_data = s2[rows, :, trial, block]
+        valid = ~np.all(np.isnan(sub_data), axis=1)
+        live = valid.reshape(len(rows), -1).any(axis=1)
+        sub_data = sub_data[live]
+    else:
+        live = valid.reshape(len(rows), -1).any(axis=1)
+        with profiling.timer('subject_fits.gather'):
+            sub_data = s2[rows[live], :, trial, block]
+    valid = valid[live]
+
+    def by_row(live_values):
+        out = np.full((len(rows), s2.shape[1]), np.nan)
+        out[live] = live_values
+        return out
+
+    if avg_over == "none":
+        return by_row(sub_data), None
+    if avg_over == "both":
+        axis = (2, 3)
+        # per-subject sem, as ERPSignal.fit computes it
+        sub_noise_arr = nansem(sub_data, axis=axis)
+    else:   # trial or block are both will be on axis=2
+        axis = 2
+        # std over the valid epochs, NaN where any of them is NaN
+        count = np.sum(~np.isnan(sub_data), axis=axis)
+        sub_noise_arr = np.where(count == valid.sum(axis=1)[:, None],
+                                 np.nanstd(sub_data, axis=axis,
+                                           dtype=np.float64), np.nan)
+    # accumulate in float64 whatever the storage dtype of s2
+    sub_vals_arr = np.nanmean(sub_data, axis=axis, dtype=np.float64)
+    return by_row(sub_vals_arr), by_row(sub_noise_arr)
+
+
+@profiling.profiled()
+def group_reduce(sub_vals_arr, sub_noise_arr=None):
+    """
+Reduce per-subject fits (see subject_fits) to the group's signal.
+    @return: (group mean, group noise)
+    """
+    if sub_noise_arr is None:
+        # in case of grouping eeg:
+        # noise is set to be the group's average signal
+        noise = nansem(sub_vals_arr, axis=0)
+    else:
+        # in case of grouping erp:
+        # noise is set to be the group's average noise
+        noise = np.nanmean(sub_noise_arr, axis=0)
+    return np.nanmean(sub_vals_arr, axis=0), noise
+
+
+def trial_block_index(trials, blocks):
+    """
+Translate 1-based trials/blocks (an int or an inclusive (start, end) range)
+into indices of the trial and block axes of s2.
+    @param trials: int or (start, end)
+    @param blocks: int or (start, end)
+    @return: (trial index, block index, averaged axes), where the averaged
+    axes are one of {"none", "trial", "block", "both"}
+    """
+    def to_index(pack):
+        if isinstance(pack, int):
+            return adjust_python_idx(pack)
+        return slice(adjust_python_idx(pack[0]), pack[1])
+
+    trial, block = to_index(trials), to_index(blocks)
+    avg_over = {(False, False): "none", (True, False): "trial",
+                (False, True): "block", (True, True): "both"}[
+        (isinstance(trial, slice), isinstance(block, slice))]
+    return trial, block, avg_over
+
+
+def get_cube(data):
+    """
+
+    @param data: data object
+    @return: the SummaryCube attached to data (see DataContext), or None
+    """
+    return getattr(data, 'cube', None)
+
+
+@profiling.profiled()
+def cube_fit(cube, rows, trial, block, avg_over, n_valid=None):
+    """
+ERP values and noise read from a SummaryCube, with the same semantics as
+ERPSignal.fit: sem over both axes, std over one (NaN where any valid epoch
+is NaN).
+    @param cube: SummaryCube
+    @param rows: subject row(s) of s2
+    @param trial: trial index (int or slice), see trial_block_index
+    @param block: block index (int or slice), see trial_block_index
+    @param avg_over: averaged axes, see trial_block_index
+    @param n_valid: number of valid epochs in the range, per row (see
+    EpochIndex.count), None if all the epochs are valid
+    @return: (values, noise), each of shape ([len(rows),] time)
+    """
+    mean, std, count = cube.range_stats(rows, trial, block)
+    if avg_over == "both":
+        with np.errstate(invalid='ignore', divide='ignore'):
+            noise = std / np.sqrt(count)
+    else:
+        if n_valid is None:
+            t0, t1 = range_bounds(trial, cube.sums.shape[2] - 1)
+            b0, b1 = range_bounds(block, cube.sums.shape[3] - 1)
+            n_valid = (t1 - t0) * (b1 - b0)
+        noise = np.where(count == np.expand_dims(n_valid, -1), std, np.nan)
+    return mean, noise
+
+
+class OnlineERP:
+    '''
+    Streaming ERP averaging, for recordings that are acquired live or are too
+    big to load at once. Epochs are accumulated one at a time or in chunks
+    with Welford/Chan updates of the per-timepoint mean, sum of squared
+    deviations and non-NaN count, so memory doesn't grow with the number of
+    epochs. fit returns the current Signal with ERPSignal.fit semantics, and
+    agrees with the batch fit up to floating point rounding.
+
+    ...
+
+    Attributes
+    ----------
+    timeline: np array
+        timeline of the epochs, sample indices (np.arange(n_time)) unless
+        given, the study's data is never loaded
+    noise: str
+        "sem" like ERPSignal over trials and blocks, or "std" like ERPSignal
+        over one of them (NaN where any valid epoch is NaN)
+    n_epochs: int
+        number of valid epochs accumulated so far, all-NaN epochs are
+        skipped like ERPSignal skips them
+
+    Methods
+    -------
+    update
+        accumulates an epoch (time,) or a chunk of epochs (time, ...)
+    fit
+        current Signal
+    '''
+
+    def __init__(self, n_time, noise="sem", timeline=None, name=None,
+                 group=None):
+        if noise not in ("sem", "std"):
+            raise ValueError(f"incorrect noise: {noise}, "
+                             "allowed are {'sem', 'std'}")
+        self.noise = noise
+        self.timeline = np.arange(n_time) if timeline is None else timeline
+        self.name = name
+        self.group = group
+        self.n_epochs = 0
+        self.count = np.zeros(n_time)
+        self.mean = np.zeros(n_time)
+        self.m2 = np.zeros(n_time)
+
+    @profiling.profiled()
+    def update(self, epochs):
+        """
+
+        @param epochs: np array (time,) of one epoch, or (time, ...) of a
+        chunk of epochs (e.g a (time, trials, blocks) slice of s2)
+        """
+        x = np.asarray(epochs, dtype=np.float64).reshape(len(self.mean), -1)
+        x = x[:, ~np.all(np.isnan(x), axis=0)]
+        valid = ~np.isnan(x)
+        n_b = valid.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_b = np.where(valid, x, 0).sum(axis=1) / n_b
+            m2_b = np.where(valid, (x - mean_b[:, None]) ** 2, 0).sum(axis=1)
+            n = self.count + n_b
+            delta = mean_b - self.mean
+            merged_mean = self.mean + delta * n_b / n
+            merged_m2 = self.m2 + m2_b + delta ** 2 * self.count * n_b / n
+        # timepoints without valid values in this chunk keep their state
+        self.mean = np.where(n_b > 0, merged_mean, self.mean)
+        self.m2 = np.where(n_b > 0, merged_m2, self.m2)
+        self.count = n
+        self.n_epochs += x.shape[1]
+
+    @profiling.profiled()
+    def fit(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(self.count > 0, self.mean, np.nan)
+            std = np.sqrt(self.m2 / self.count)
+        if self.noise == "sem":
+            # same n as nansem over ERPSignal's data
+            noise = std / np.sqrt(self.count)
+        else:   # np.std propagates NaN epochs
+            noise = np.where(self.count == self.n_epochs, std, np.nan)
+        return Signal(values=values, timeline=self.timeline, noise=noise,
+                      name=self.name, group=self.group)
+
+
 class Component:
+    @profiling.profiled('Component')
     def __init__(self, orientation, t1, t2, signal, baseline=0):
+        """
+
+        @param baseline: value subtracted from the signal, or a method of
+        baseline.BASELINE_METHODS (e.g "Walter") computed on the signal
+        """
         self.orientation = orientation
         self.t1, self.t2 = t1, t2
-        boundaries = self.__get_t_idx(signal.timeline, [self.t1, self.t2])
-        self.timeline = signal.timeline[boundaries[0]:boundaries[1]]
-        self.values = signal.values[boundaries[0]:boundaries[1]]
+        window = as_timeline(signal.timeline).span(self.t1, self.t2)
+        self.timeline = signal.timeline[window]
+        self.values = signal.values[window]
+        if isinstance(baseline, str):
+            check_method(baseline)
+            # both methods level an averaged signal at its pre-stimulus mean
+            baseline = walter_baseline(signal)
         self.baseline = baseline
 
     def __repr__(self):
         return f'Component {self.orientation}{self.t1}-{self.t2} post-onset'
 
-    def __get_t_idx(self, timeline, t):
-        vf = np.vectorize(lambda t: np.argmin(np.abs(timeline - t)))
-        return vf(t)  # idx for corresponding t (same length)
-
+    @profiling.profiled()
     def sum(self, **kwargs):
         return np.nansum(self.values - self.baseline, **kwargs)
 
+    @profiling.profiled()
     def abs_sum(self):
         return np.nansum(np.abs(self.values - self.baseline))
 
     # TODO: bugfix - RuntimeWarning: invalid value encountered in sqrt
+    @profiling.profiled()
     def rms(self, **kwargs):
         return np.sqrt(np.nanmean(self.values - self.baseline, **kwargs))
 
+    @profiling.profiled()
     def peak(self, **kwargs):
         if self.orientation == "N":
             return np.nanmin(self.values - self.baseline, **kwargs)
         if self.orientation == "P":
             return np.max(self.values - self.baseline, **kwargs)
 
+    @profiling.profiled()
     def auc(self, absolute_val=False, **kwargs):
         if absolute_val:
             y = np.abs(self.values - self.baseline)
         else:
             y = self.values - self.baseline
-        return np.trapz(y=y, x=self.timeline, **kwargs)
-
-def nansem(a, **kwargs):
+        return trapezoid(y=y, x=self.timeline, **kwargs)
+
+def walter_baseline(signal, window=PRESTIM_WINDOW):
+    """
+Walter baseline level of a signal (see baseline.py): the mean of its values
+over the window, the pre-stimulus part of the timeline by default.
+    @param signal: Signal
+    @param window: (t1, t2) in ms, see baseline.window_slice
+    @return: float, NaN if the window has no values
+    """
+    values = np.asarray(signal.values)[window_slice(signal.timeline, window)]
+    count = np.sum(~np.isnan(values))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return float(np.nansum(values, dtype=np.float64) / count)
+
+
+@profiling.profiled()
+def nansem(a, axis=None, **kwargs):
     '''
     https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.sem.html
     '''
     # bug (memoryview obj)
     # return sem(a, nan_policy="omit", **kwargs).data
-    n = len(a.flatten())
-    return np.nanstd(a, **kwargs)/np.sqrt(n)
+    # n is the number of non-NaN values along axis
+    n = np.sum(~np.isnan(a), axis=axis)
+    kwargs.setdefault('dtype', np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nanstd(a, axis=axis, **kwargs) / np.sqrt(n)
 
 def softmax(x):
     return np.exp(x) / np.nansum(np.exp(x))
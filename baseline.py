@@ -0,0 +1,147 @@
+"""
+Baseline correction of the whole s2 tensor (subjects, time, trials, blocks).
+
+Methods:
+    'prestim': each epoch minus its own mean over the window (by default
+    the pre-stimulus part of the timeline, time < 0).
+    'walter': each subject minus one level, the mean of the window over all
+    of the subject's epochs, i.e the pre-stimulus level of its average as
+    plot.add_baseline draws it. Slow shifts between epochs (e.g
+    anticipatory, CNV like potentials) are kept, only the subject's offset
+    is removed.
+
+Baseline levels are computed once for the tensor, with a broadcast over the
+time axis. Corrected data is either a lazy view (BaselineArray, slices are
+corrected when read) or s2 itself corrected in place, and a corrected data
+object (see baseline_corrected) feeds ERPSignal, GroupSignal and
+Component as is.
+"""
+import numpy as np
+import profiling
+from data_ingestion import ArrayProxy, as_timeline, time_axis
+
+BASELINE_METHODS = ('prestim', 'walter')
+# [t1, t2) in ms, None for the timeline's start (or end)
+PRESTIM_WINDOW = (None, 0)
+
+
+def window_slice(timeline, window=PRESTIM_WINDOW):
+    """
+
+    @param timeline: Timeline, or sorted 1-d np array
+    @param window: (t1, t2) in ms, see PRESTIM_WINDOW
+    @return: slice of the timeline points in [t1, t2)
+    """
+    return as_timeline(timeline).window(*window)
+
+
+def check_method(method):
+    """
+
+    @param method: baseline method, case insensitive (e.g "Walter")
+    @return: its name in BASELINE_METHODS
+    """
+    name = str(method).lower()
+    if name not in BASELINE_METHODS:
+        raise ValueError(f"unknown baseline method: {method}, "
+                         f"allowed are {BASELINE_METHODS}")
+    return name
+
+
+@profiling.profiled()
+def baseline_levels(s2, timeline, method='prestim', window=PRESTIM_WINDOW,
+                    chunk=8):
+    """
+
+    @param s2: eeg tensor (subjects, time, trials, blocks), array or proxy
+    @param timeline: timeline of s2's time axis
+    @param method: one of BASELINE_METHODS
+    @param window: (t1, t2) window of the baseline, see window_slice
+    @param chunk: number of subjects read at once
+    @return: float64 np array broadcastable against s2, (subjects, 1,
+    trials, blocks) for 'prestim', (subjects, 1, 1, 1) for 'walter'; NaN
+    where the window has no values
+    """
+    method = check_method(method)
+    win = window_slice(timeline, window)
+    axis = 1 if method == 'prestim' else (1, 2, 3)
+    n_sub, _, n_trials, n_blocks = s2.shape
+    if method == 'prestim':
+        out = np.empty((n_sub, 1, n_trials, n_blocks))
+    else:
+        out = np.empty((n_sub, 1, 1, 1))
+    for start in range(0, n_sub, chunk):
+        x = np.asarray(s2[start:start + chunk, win])
+        total = np.nansum(x, axis=axis, keepdims=True, dtype=np.float64)
+        count = np.sum(~np.isnan(x), axis=axis, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[start:start + chunk] = total / count
+    return out
+
+
+class BaselineArray(ArrayProxy):
+    '''
+    Lazy baseline corrected view of s2: the levels are subtracted from the
+    requested slice only, s2 is neither copied nor modified.
+
+    ...
+
+    Attributes
+    ----------
+    s2: np array or ArrayProxy
+        the uncorrected tensor
+    levels: np array
+        baseline levels broadcastable against s2, see baseline_levels
+    '''
+
+    def __init__(self, s2, levels):
+        self.s2 = s2
+        self.shape = tuple(s2.shape)
+        self.levels = levels
+        self.dtype = np.result_type(s2.dtype, levels.dtype)
+
+    def __getitem__(self, key):
+        # the levels indexed like s2, without materializing them
+        levels = np.broadcast_to(self.levels, self.shape)[key]
+        out = np.asarray(np.asarray(self.s2[key]) - levels)
+        return out[()] if out.ndim == 0 else out
+
+
+@profiling.profiled()
+def subtract_baseline(s2, levels, chunk=8):
+    """
+Correct s2 in place.
+    @param s2: writable np array (subjects, time, trials, blocks)
+    @param levels: see baseline_levels
+    @param chunk: number of subjects corrected at once
+    @return: s2
+    """
+    if not isinstance(s2, np.ndarray) or not s2.flags.writeable:
+        raise ValueError("s2 is read only (e.g memory-mapped from the cache), "
+                         "use a BaselineArray view instead")
+    for start in range(0, len(s2), chunk):
+        rows = slice(start, start + chunk)
+        np.subtract(s2[rows], levels[rows], out=s2[rows], casting='unsafe')
+    return s2
+
+
+def baseline_corrected(data, method='prestim', window=PRESTIM_WINDOW,
+                       in_place=False):
+    """
+
+    @param data: data object
+    @param method: one of BASELINE_METHODS
+    @param window: see baseline_levels
+    @param in_place: correct data's s2 itself instead of a lazy view
+    @return: a data object sharing data's entries, with the corrected s2
+    (and no summary cube, which holds uncorrected sums)
+    """
+    s2 = data['s2']
+    levels = baseline_levels(s2, time_axis(data), method, window)
+    corrected = {key: data[key] for key in data.keys()}
+    if in_place:
+        corrected['s2'] = subtract_baseline(s2, levels)
+    else:
+        corrected['s2'] = BaselineArray(s2, levels)
+    corrected['baseline'] = (check_method(method), window)
+    return corrected
@@ -0,0 +1,226 @@
+"""
+Single-trial brain-behaviour coupling: the E-Prime RT's of data['behave']
+joined to the epochs of s2, with RT-binned ERPs and per-timepoint
+correlation / regression of amplitude on RT, computed for all the subjects
+at once as batched tensor operations (chunks of subjects).
+"""
+import numpy as np
+import profiling
+from analysis import Signal, group_reduce, default_timeline
+from data_ingestion import mat_data, subject_index
+
+
+def rt_grid(behave, n_trials, n_blocks, order="block"):
+    """
+Reshape the RT's of every subject onto s2's trial x block grid.
+    @param behave: (subjects, RT's) matrix, as data['behave']
+    @param n_trials: number of trials per block of s2
+    @param n_blocks: number of blocks of s2
+    @param order: "block" if the RT's are logged block after block (the
+    trial runs fastest, as E-Prime logs them), "trial" if trial after trial
+    @return: (subjects, n_trials, n_blocks) np array of RT's, NaN for
+    missing responses
+    """
+    behave = np.asarray(behave, dtype=np.float64)
+    n = n_trials * n_blocks
+    if behave.shape[1] != n:
+        raise ValueError(f"{behave.shape[1]} RT's per subject don't fit a "
+                         f"grid of {n_trials} trials x {n_blocks} blocks")
+    if order == "block":
+        return behave.reshape(-1, n_blocks, n_trials).transpose(0, 2, 1)
+    if order == "trial":
+        return behave.reshape(-1, n_trials, n_blocks)
+    raise ValueError(f"incorrect order: {order}, "
+                     "allowed are {'block', 'trial'}")
+
+
+def study_rts(data=mat_data, order="block"):
+    """
+
+    @param data: data object with behavioural data (see insert_behave_data)
+    @param order: see rt_grid
+    @return: (subjects, trials, blocks) RT's aligned with s2's epochs
+    """
+    return rt_grid(data['behave'], *data['s2'].shape[2:], order=order)
+
+
+def rt_bins(rts, bins=4):
+    """
+
+    @param rts: (subjects, trials, blocks) RT's, see rt_grid
+    @param bins: number of bins, split at each subject's RT quantiles, or
+    an increasing array of bin edges in ms shared by all subjects
+    @return: (int np array (subjects, trials, blocks) of bin indices, -1 for
+    epochs without RT or outside the edges, (subjects, n bins + 1) edges)
+    """
+    flat = rts.reshape(len(rts), -1)
+    missing = np.isnan(flat)
+    if np.ndim(bins) == 0:
+        edges = np.full((len(flat), bins + 1), np.nan)
+        has_rts = ~np.all(missing, axis=1)
+        edges[has_rts] = np.nanquantile(
+            flat[has_rts], np.linspace(0, 1, bins + 1), axis=1).T
+    else:
+        edges = np.broadcast_to(np.asarray(bins, dtype=np.float64),
+                                (len(flat), len(bins)))
+    with np.errstate(invalid='ignore'):
+        idx = np.sum(flat[:, :, None] >= edges[:, None, 1:-1], axis=-1)
+        outside = (flat < edges[:, :1]) | (flat > edges[:, -1:])
+    idx[missing | outside] = -1
+    return idx.reshape(rts.shape), edges
+
+
+def epochs_matrix(s2, rows):
+    """
+
+    @param s2: eeg tensor (subjects, time, trials, blocks), array or proxy
+    @param rows: int np array of subjects rows
+    @return: (len(rows), time, epochs) float64 np array of the rows' epochs
+    """
+    with profiling.timer('epochs_matrix.gather'):
+        x = np.asarray(s2[rows], dtype=np.float64)
+    return x.reshape(x.shape[0], x.shape[1], -1)
+
+
+@profiling.profiled()
+def binned_erps(s2, bin_idx, n_bins, rows=None, chunk=8):
+    """
+ERPs of every subject per RT bin, with one batched matmul of the epochs
+against the bins' one-hot matrix per chunk of subjects.
+    @param s2: eeg tensor (subjects, time, trials, blocks), array or proxy
+    @param bin_idx: (len(rows), trials, blocks) bin indices, see rt_bins
+    @param n_bins: number of bins
+    @param rows: int np array of subjects rows, None for all
+    @param chunk: number of subjects processed at once
+    @return: (values, noise, counts): values and noise (sem, as nansem)
+    of shape (len(rows), n_bins, time), counts (len(rows), n_bins) of valid
+    epochs in each bin
+    """
+    rows = np.arange(len(s2)) if rows is None else np.asarray(rows)
+    n_sub, n_time = len(rows), s2.shape[1]
+    values = np.empty((n_sub, n_bins, n_time))
+    noise = np.empty((n_sub, n_bins, n_time))
+    counts = np.empty((n_sub, n_bins), dtype=np.intp)
+    onehot_all = (bin_idx.reshape(n_sub, -1, 1) ==
+                  np.arange(n_bins)).astype(np.float64)
+    for start in range(0, n_sub, chunk):
+        part = slice(start, start + chunk)
+        x = epochs_matrix(s2, rows[part])
+        onehot = onehot_all[part]           # (subjects, epochs, bins)
+        valid = ~np.isnan(x)
+        x = np.where(valid, x, 0)
+        n = valid.astype(np.float64) @ onehot   # (subjects, time, bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (x @ onehot) / n
+            std = np.sqrt(np.maximum((x ** 2 @ onehot) / n - mean ** 2, 0))
+            sem = std / np.sqrt(n)
+        values[part] = mean.transpose(0, 2, 1)
+        noise[part] = sem.transpose(0, 2, 1)
+        epoch_valid = valid.any(axis=1).astype(np.float64)
+        counts[part] = np.einsum('se,seb->sb', epoch_valid, onehot)
+    return values, noise, counts
+
+
+@profiling.profiled()
+def rt_coupling(s2, rts, rows=None, chunk=8):
+    """
+Per-timepoint Pearson correlation and least squares regression of the
+amplitude on the RT, across each subject's epochs (pairwise complete:
+epochs with an RT and a non-NaN amplitude).
+    @param s2: eeg tensor (subjects, time, trials, blocks), array or proxy
+    @param rts: (len(rows), trials, blocks) RT's, see rt_grid
+    @param rows: int np array of subjects rows, None for all
+    @param chunk: number of subjects processed at once
+    @return: dict of (len(rows), time) np arrays: 'r', 'slope' (uV per ms),
+    'intercept' (uV) and 'n' (number of epochs)
+    """
+    rows = np.arange(len(s2)) if rows is None else np.asarray(rows)
+    n_sub, n_time = len(rows), s2.shape[1]
+    out = {key: np.empty((n_sub, n_time))
+           for key in ('r', 'slope', 'intercept', 'n')}
+    y_all = rts.reshape(n_sub, -1)
+    has_y_all = ~np.isnan(y_all)
+    # RT's centered per subject, against cancellation in the moments
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y_mean_all = (np.where(has_y_all, y_all, 0).sum(axis=1) /
+                      has_y_all.sum(axis=1))
+    for start in range(0, n_sub, chunk):
+        part = slice(start, start + chunk)
+        x = epochs_matrix(s2, rows[part])
+        has_y = has_y_all[part]
+        y = np.where(has_y, y_all[part] - y_mean_all[part, None], 0)
+        w = ~np.isnan(x) & has_y[:, None, :]    # (subjects, time, epochs)
+        x = np.where(w, x, 0)
+        wf = w.astype(np.float64)
+        n = wf.sum(axis=-1)
+        # moments over the epochs, as batched matmuls
+        sx, sxx = x.sum(axis=-1), (x ** 2).sum(axis=-1)
+        sy = (wf @ y[:, :, None])[..., 0]
+        syy = (wf @ (y ** 2)[:, :, None])[..., 0]
+        sxy = (x @ y[:, :, None])[..., 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mx, my = sx / n, sy / n
+            cov = sxy / n - mx * my
+            var_x = np.maximum(sxx / n - mx ** 2, 0)
+            var_y = np.maximum(syy / n - my ** 2, 0)
+            slope = cov / var_y
+            out['r'][part] = cov / np.sqrt(var_x * var_y)
+        out['slope'][part] = slope
+        out['intercept'][part] = mx - slope * (my + y_mean_all[part, None])
+        out['n'][part] = n
+    return out
+
+
+def fisher_mean(r, axis=0):
+    """
+
+    @param r: np array of correlations
+    @param axis: averaged axis, e.g subjects
+    @return: average correlation through Fisher's z transform
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = np.arctanh(np.clip(r, -1 + 1e-12, 1 - 1e-12))
+    return np.tanh(np.nanmean(z, axis=axis))
+
+
+def rt_binned_signals(group, bins=4, data=mat_data, order="block",
+                      timeline=None):
+    """
+Group ERPs per RT bin, reduced over subjects as GroupSignal.fit does.
+    @param group: group name
+    @param bins: see rt_bins
+    @param data: data object with behavioural data
+    @param order: see rt_grid
+    @param timeline: timeline of the signals, None for data's
+    @return: (list of Signal, one per bin, (subjects of the group, n bins +
+    1) edges)
+    """
+    rows = subject_index(data).group(group)
+    bin_idx, edges = rt_bins(study_rts(data, order)[rows], bins)
+    n_bins = edges.shape[1] - 1
+    values, noise, _ = binned_erps(data['s2'], bin_idx, n_bins, rows)
+    timeline = default_timeline(data) if timeline is None else timeline
+    signals = []
+    for b in range(n_bins):
+        mean_vals, group_noise = group_reduce(values[:, b], noise[:, b])
+        # no group colors, bins are told apart by the default color cycle
+        signals.append(Signal(values=mean_vals, timeline=timeline,
+                              noise=group_noise,
+                              name=f'{group}|RT bin {b + 1}'))
+    return signals, edges
+
+
+def rt_correlation_signal(group, data=mat_data, order="block", timeline=None):
+    """
+Group's per-timepoint amplitude / RT correlation.
+    @param group: group name
+    @param data: data object with behavioural data
+    @param order: see rt_grid
+    @param timeline: timeline of the signal, None for data's
+    @return: Signal of the subjects' correlations averaged by fisher_mean
+    """
+    rows = subject_index(data).group(group)
+    coupling = rt_coupling(data['s2'], study_rts(data, order)[rows], rows)
+    timeline = default_timeline(data) if timeline is None else timeline
+    return Signal(values=fisher_mean(coupling['r']), timeline=timeline,
+                  name=f'{group}|r(amplitude, RT)', group=group)
@@ -0,0 +1,196 @@
+"""
+Benchmarks of eegtools hot paths, results are printed (or written) as JSON
+for regression tracking.
+
+    python benchmark.py suite <work folder> [--scales small,medium] [--out f]
+    python benchmark.py eprime <behave_path> <eprime_patterns.json>
+"""
+import argparse
+import chardet
+import json
+import numpy as np
+import os
+import platform
+import re
+import time
+import plot
+import synthetic
+from analysis import Signal, EEGSignal, ERPSignal, GroupSignal, Component
+from data_ingestion import EPrime, EPrimePatterns, DataContext, epoch_index
+from features import ComponentSpec, extract_features
+
+# synthetic dataset sizes, see synthetic.make_dataset
+SCALES = {'small': dict(n_subjects=10, n_time=500),
+          'medium': dict(n_subjects=40, n_time=1000),
+          'large': dict(n_subjects=100, n_time=2000)}
+
+
+def best_time(func, repeat=3):
+    """
+
+    @param func: callable without arguments
+    @param repeat: number of runs
+    @return: fastest wall time of func in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def legacy_eprime_parse(filename, patterns):
+    """
+EPrime parsing as it was before EPrimePatterns, kept as the benchmark's
+baseline: chardet over the whole file, and a compile of the pattern per
+field lookup.
+    """
+    with open(filename, 'rb') as f:
+        bin_data = f.read()
+    decoded = bin_data.decode(chardet.detect(bin_data)['encoding'])
+    out = {}
+    for field, pat in patterns['meta'].items():
+        match = re.compile(pat).search(decoded)
+        out['meta', field] = match and match.group()
+    for field, pat in patterns['data'].items():
+        out['data', field] = re.compile(pat).findall(decoded)
+    return out
+
+
+def bench_eprime(filenames, patterns, repeat=3):
+    """
+
+    @param filenames: E-Prime txt files
+    @param patterns: dict of E-Prime patterns, see EPrime
+    @param repeat: number of runs, the fastest is reported
+    @return: dict of files/sec of the legacy parser and of EPrimePatterns
+    """
+    def legacy():
+        for fn in filenames:
+            legacy_eprime_parse(fn, patterns)
+
+    def engine():
+        compiled = EPrimePatterns(patterns)
+        for fn in filenames:
+            EPrime(fn, compiled).fields
+
+    legacy_sec = best_time(legacy, repeat)
+    engine_sec = best_time(engine, repeat)
+    return {'files': len(filenames),
+            'legacy_files_per_sec': len(filenames) / legacy_sec,
+            'engine_files_per_sec': len(filenames) / engine_sec,
+            'speedup': legacy_sec / engine_sec}
+
+
+def bench_scale(config_filename, repeat=3):
+    """
+
+    @param config_filename: CONFIG.yaml of a (synthetic) dataset
+    @param repeat: number of runs, the fastest is reported
+    @return: dict benchmark name -> seconds
+    """
+    timings = {}
+    data = DataContext(config_filename)
+    timings['ingest_cold'] = best_time(lambda: data.load(use_cache=False),
+                                       repeat)
+    data.load()     # fill the cache
+    timings['ingest_warm'] = best_time(data.load, repeat)
+
+    timeline = data['time']
+    name, group = data['subjects'][0], data['group'][0]
+    n_trials, n_blocks = data['s2'].shape[2:]
+    trials, blocks = (1, n_trials), (1, n_blocks)
+    timings['eeg_signal'] = best_time(
+        lambda: EEGSignal(name, 1, 1, timeline=timeline, data=data), repeat)
+    timings['erp_fit'] = best_time(
+        lambda: ERPSignal(name, trials, blocks, timeline=timeline,
+                          data=data).fit(), repeat)
+    timings['group_fit_epoch'] = best_time(
+        lambda: GroupSignal(group, 1, 1, timeline=timeline,
+                            data=data).fit(), repeat)
+    timings['group_fit_erp'] = best_time(
+        lambda: GroupSignal(group, trials, blocks, timeline=timeline,
+                            data=data).fit(), repeat)
+
+    sig = ERPSignal(name, trials, blocks, timeline=timeline, data=data).fit()
+
+    def component_metrics():
+        for orientation, t1, t2 in (("N", 80, 120), ("P", 150, 250)):
+            comp = Component(orientation, t1, t2, sig)
+            comp.sum(), comp.abs_sum(), comp.rms(), comp.peak(), comp.auc()
+    timings['component_metrics'] = best_time(component_metrics, repeat)
+    specs = [ComponentSpec('N100', 'N', 80, 120),
+             ComponentSpec('P200', 'P', 150, 250)]
+    timings['extract_features'] = best_time(
+        lambda: extract_features(data['s2'], specs, timeline,
+                                 valid=epoch_index(data).valid), repeat)
+
+    signals = [GroupSignal(g, trials, blocks, timeline=timeline,
+                           data=data).fit() for g in np.unique(data['group'])]
+
+    def figure():
+        fig = plot.init_trial()
+        for s in signals:
+            # a new Signal, get_gos caches the trace it builds
+            fig.add_trace(Signal(s.values, s.timeline, s.noise, s.name,
+                                 s.group).get_gos())
+        return fig.to_json()
+    timings['figure'] = best_time(figure, repeat)
+    return timings
+
+
+def bench_suite(path, scales=('small', 'medium'), repeat=3):
+    """
+
+    @param path: work folder for the synthetic datasets
+    @param scales: names of SCALES to run
+    @param repeat: see bench_scale
+    @return: dict of environment, and per scale its parameters and timings
+    """
+    results = {'env': {'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+               'scales': {}}
+    for scale in scales:
+        config_filename = synthetic.make_dataset(os.path.join(path, scale),
+                                                 **SCALES[scale])
+        results['scales'][scale] = {
+            'params': SCALES[scale],
+            'seconds': bench_scale(config_filename, repeat)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    sub = parser.add_subparsers(dest='bench', required=True)
+    suite = sub.add_parser('suite', help='synthetic data, all hot paths')
+    suite.add_argument('path')
+    suite.add_argument('--scales', default='small,medium',
+                       help=f'comma separated of {", ".join(SCALES)}')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--out', help='JSON file to write results to')
+    eprime = sub.add_parser('eprime', help='E-Prime parsing files/sec')
+    eprime.add_argument('behave_path')
+    eprime.add_argument('eprime_patterns')
+    eprime.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.bench == 'suite':
+        result = bench_suite(args.path, args.scales.split(','), args.repeat)
+    elif args.bench == 'eprime':
+        with open(args.eprime_patterns, 'r') as jf:
+            patterns = json.load(jf)
+        filenames = [os.path.join(args.behave_path, fn)
+                     for fn in sorted(os.listdir(args.behave_path))
+                     if fn.endswith('.txt')]
+        result = bench_eprime(filenames, patterns, args.repeat)
+    if getattr(args, 'out', None):
+        with open(args.out, 'w') as jf:
+            json.dump(result, jf, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import sys
+
+
+def sizeof(obj):
+    """
+
+    @param obj: cached value
+    @return: size in bytes of obj, its nbytes attribute if it has one
+    """
+    nbytes = getattr(obj, 'nbytes', None)
+    return sys.getsizeof(obj) if nbytes is None else int(nbytes)
+
+
+class LRUCache:
+    '''
+    Bounded least-recently-used cache, capped by the total size in bytes of
+    its values (and optionally by number of items). Used to memoize fitted
+    Signals by their normalized query.
+
+    ...
+
+    Attributes
+    ----------
+    max_bytes: int
+        size cap of all cached values together
+    max_items: int
+        cap of number of cached values, None for no cap
+    hits, misses, evictions: int
+        usage counters
+
+    Methods
+    -------
+    get_or_compute
+        returns the cached value of a key, computing and caching it on a miss
+    stats
+        dict of usage counters and current size
+    '''
+
+    def __init__(self, max_bytes=256 * 2 ** 20, max_items=None,
+                 sizeof=sizeof):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = sizeof
+        self._items = OrderedDict()    # key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        if key in self._items:
+            self.nbytes -= self._items.pop(key)[1]
+        if nbytes > self.max_bytes:     # would evict everything else
+            return
+        self._items[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes or \
+                (self.max_items is not None and
+                 len(self._items) > self.max_items):
+            _, (_, evicted_bytes) = self._items.popitem(last=False)
+            self.nbytes -= evicted_bytes
+            self.evictions += 1
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """
+
+        @param key: hashable normalized query
+        @param func: computes the value on a miss, called with args, kwargs
+        @return: cached or computed value
+        """
+        if key in self._items:
+            return self.get(key)
+        self.misses += 1
+        value = func(*args, **kwargs)
+        self.put(key, value)
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'items': len(self._items),
+                'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
@@ -0,0 +1,144 @@
+import numpy as np
+import os
+
+CUBE_FILES = ('sums', 'sq_sums', 'counts')
+
+
+class SummaryCube:
+    '''
+    Precomputed summary statistics of the s2 tensor: 2d prefix sums
+    (summed-area tables) over the trial and block axes of the values, the
+    squared values and the non-NaN counts, for each subject and time point.
+    The sum over any contiguous trial-block range is then read from 4 corners
+    of each table, so a range mean/std costs O(time) instead of
+    O(time x trials x blocks).
+
+    Std is computed as sqrt(E[x^2] - E[x]^2), it agrees with np.nanstd up to
+    floating point cancellation (relative error ~1e-12 for EEG amplitudes).
+
+    ...
+
+    Attributes
+    ----------
+    sums: np array
+        (subjects, time, trials + 1, blocks + 1) prefix sums of values
+    sq_sums: np array
+        same shape, prefix sums of squared values
+    counts: np array
+        same shape, prefix sums of non-NaN counts
+
+    Methods
+    -------
+    build
+        computes the cube from s2
+    save, load
+        persist the cube in a folder (loaded memory-mapped)
+    range_stats
+        mean, std and count over a trial-block range
+    '''
+
+    def __init__(self, sums, sq_sums, counts):
+        self.sums = sums
+        self.sq_sums = sq_sums
+        self.counts = counts
+
+    @classmethod
+    def build(cls, s2, chunk=8, path=None):
+        """
+
+        @param s2: eeg tensor (subjects, time, trials, blocks), array or proxy
+        @param chunk: number of subjects processed at once
+        @param path: folder to stream the tables into (.npy files, as save
+        writes them), so the cube doesn't have to fit in RAM; None builds it
+        in RAM
+        @return: SummaryCube of s2 (memory-mapped from path if given)
+        """
+        n_sub, n_time, n_trials, n_blocks = s2.shape
+        shape = (n_sub, n_time, n_trials + 1, n_blocks + 1)
+        dtypes = (np.float64, np.float64, np.int32)
+        if path is None:
+            tables = [np.zeros(shape, dtype=dtype) for dtype in dtypes]
+        else:
+            os.makedirs(path, exist_ok=True)
+            # written aside and renamed when complete, load checks the names
+            tables = [np.lib.format.open_memmap(
+                os.path.join(path, f'cube_{name}.npy.tmp'), mode='w+',
+                dtype=dtype, shape=shape)
+                for name, dtype in zip(CUBE_FILES, dtypes)]
+        for start in range(0, n_sub, chunk):
+            x = np.asarray(s2[start:start + chunk], dtype=np.float64)
+            valid = ~np.isnan(x)
+            x = np.where(valid, x, 0)
+            rows = slice(start, start + len(x))
+            for table, values in zip(tables, (x, x ** 2, valid)):
+                table[rows, :, 0] = 0
+                table[rows, :, :, 0] = 0
+                table[rows, :, 1:, 1:] = values.cumsum(axis=2).cumsum(axis=3)
+        if path is None:
+            return cls(*tables)
+        for table in tables:
+            table.flush()
+        del tables, table   # closes the memory maps before the renames
+        for name in CUBE_FILES:
+            filename = os.path.join(path, f'cube_{name}.npy')
+            os.replace(filename + '.tmp', filename)
+        return cls.load(path)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in CUBE_FILES:
+            np.save(os.path.join(path, f'cube_{name}.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+
+        @param path: folder the cube was saved to
+        @param mmap_mode: numpy mmap mode, None loads the cube to RAM
+        @return: SummaryCube, or None if there is no cube in the folder
+        """
+        files = [os.path.join(path, f'cube_{name}.npy') for name in CUBE_FILES]
+        if not all(os.path.exists(fn) for fn in files):
+            return None
+        return cls(*[np.load(fn, mmap_mode=mmap_mode) for fn in files])
+
+    def range_sums(self, rows, trial, block):
+        """
+
+        @param rows: subject row(s) of s2, int or int array
+        @param trial: trial index of s2, int or slice (step 1)
+        @param block: block index of s2, int or slice (step 1)
+        @return: (sum, squares sum, count) over the trial-block range
+        """
+        t0, t1 = range_bounds(trial, self.sums.shape[2] - 1)
+        b0, b1 = range_bounds(block, self.sums.shape[3] - 1)
+        out = []
+        for table in (self.sums, self.sq_sums, self.counts):
+            out.append(table[rows, :, t1, b1] - table[rows, :, t0, b1] -
+                       table[rows, :, t1, b0] + table[rows, :, t0, b0])
+        return tuple(out)
+
+    def range_stats(self, rows, trial, block):
+        """
+
+        @return: (mean, std, count) over the trial-block range, NaN where
+        there are no valid values (see range_sums for params)
+        """
+        total, sq_total, count = self.range_sums(rows, trial, block)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            var = sq_total / count - mean ** 2
+        return mean, np.sqrt(np.maximum(var, 0)), count
+
+
+def range_bounds(idx, n):
+    """
+
+    @param idx: int or slice (step 1) of an axis
+    @param n: length of the axis
+    @return: (start, end) of the range in prefix-sum coordinates
+    """
+    if isinstance(idx, slice):
+        start, stop, _ = idx.indices(n)
+        return start, max(start, stop)
+    return idx, idx + 1
@@ -1,65 +1,277 @@
+import asyncio
+import numpy as np
 import plot
+import profiling
 import widgets
-from ipywidgets import interactive, fixed
-from analysis import EEGSignal, ERPSignal, GroupSignal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from ipywidgets import interactive, fixed, VBox, IntProgress
+from analysis import EEGSignal, ERPSignal, GroupSignal, Signal, \
+    default_timeline, subject_fits, group_reduce, trial_block_index, get_cube
+from caching import LRUCache
+from data_ingestion import mat_data, subject_index, epoch_index, time_axis
 
 
 
-def sub_board(fig, name, trial_start, block_start, trial_end, block_end):
+# fitted Signals by data key and normalized query, shared by the dashboards
+FIT_CACHE = LRUCache(max_bytes=128 * 2 ** 20)
+# fits run on this thread, the kernel's one keeps serving the widgets (numpy
+# releases the GIL in the reductions, and threads share the memory-mapped
+# data, which a process pool would have to pickle)
+FIT_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# subjects per step of a group fit, the figure is updated after each step
+GROUP_STEP = 4
+# newest AsyncBoard of each dashboard, see new_board
+BOARDS = {}
+
+
+def fit_sub(name, trials, blocks):
+    if isinstance(trials, int) and isinstance(blocks, int):
+        return EEGSignal(name, trial=trials, block=blocks)
+    return ERPSignal(name, trials, blocks).fit()
+
+
+def fit_group(group, trials, blocks):
+    return GroupSignal(group, trials, blocks).fit()
+
+
+def group_fit_steps(group, trials, blocks, step_size=GROUP_STEP):
+    """
+GroupSignal.fit split in steps of step_size subjects, see AsyncBoard.
+    @return: (steps, finish): callables, each fitting the subjects of a step,
+    and finish(parts) -> Signal of the group's subjects fitted so far (the
+    group's Signal once all steps are done)
+    """
+    if get_cube(mat_data) is not None:     # fast enough in a single step
+        return [partial(fit_group, group, trials, blocks)], \
+            lambda parts: parts[0]
+    rows = subject_index(mat_data).group(group)
+    trial, block, avg_over = trial_block_index(trials, blocks)
+    epochs = epoch_index(mat_data)
+
+    def fit_rows(step_rows):
+        return subject_fits(mat_data['s2'], step_rows, trial, block, avg_over,
+                            valid=epochs.mask(step_rows, trial, block))
+
+    def finish(parts):
+        sub_vals_arr = np.concatenate([vals for vals, _ in parts])
+        sub_noise_arr = None
+        if avg_over != "none":
+            sub_noise_arr = np.concatenate([noise for _, noise in parts])
+        mean_vals, noise = group_reduce(sub_vals_arr, sub_noise_arr)
+        return Signal(values=mean_vals, noise=noise,
+                      timeline=default_timeline(), group=group)
+
+    steps = [partial(fit_rows, rows[i:i + step_size])
+             for i in range(0, len(rows), step_size)]
+    return steps, finish
+
+
+class AsyncBoard:
+    '''
+    Runs a dashboard's fits in the background: a board callback returns at
+    once, the fit's steps run on an executor while the kernel keeps serving
+    the widgets, and the figure is updated as the steps complete. A new
+    request, or a change of a watched widget, supersedes the running one:
+    its pending steps are cancelled and its late results are dropped, so the
+    newest query always wins. Each dashboard watches its own query widgets
+    (see widgets.query_widgets), so one dashboard's sliders never cancel
+    another's fit.
+
+    ...
+
+    Attributes
+    ----------
+    fig: go.FigureWidget
+        the board's figure
+    executor: concurrent.futures.Executor
+        runs the steps, FIT_EXECUTOR by default
+    progress: ipywidgets.IntProgress
+        steps done of the running request, hidden when idle
+    generation: int
+        number of the newest request, results of older ones are dropped
+
+    Methods
+    -------
+    submit
+        runs a request's steps in the background
+    cancel
+        drops the running request
+    watch
+        cancels the running request when widgets change
+    '''
+
+    def __init__(self, fig, executor=None):
+        self.fig = fig
+        self.executor = executor or FIT_EXECUTOR
+        self.progress = IntProgress(value=0, min=0, max=1,
+                                    description='fitting',
+                                    layout={'visibility': 'hidden'})
+        self.generation = 0
+        self._task = None
+        self._discard = None
+
+    def cancel(self, *_):
+        self.generation += 1
+        if self._task is not None:
+            # cancels the executor's pending step too, a running one
+            # completes and its result is dropped
+            self._task.cancel()
+            self._task = None
+        if self._discard is not None:
+            self._discard()
+            self._discard = None
+        self.progress.layout.visibility = 'hidden'
+
+    def watch(self, *widgets):
+        for widget in widgets:
+            widget.observe(self.cancel, names='value')
+
+    def submit(self, steps, deliver, discard=None):
+        """
+
+        @param steps: callables run in order on the executor, each returns
+        a part of the result
+        @param deliver: deliver(parts, done) is called on the kernel's
+        thread after each step with the parts so far, e.g to draw them
+        @param discard: called if the request is superseded after a
+        delivery, e.g to remove its partial trace
+        """
+        self.cancel()
+        run = self._run(self.generation, steps, deliver, discard)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:    # no event loop (not in a kernel), blocks
+            asyncio.run(run)
+            return
+        self._task = loop.create_task(run)
+
+    async def _run(self, generation, steps, deliver, discard):
+        loop = asyncio.get_running_loop()
+        self.progress.max, self.progress.value = max(1, len(steps)), 0
+        self.progress.layout.visibility = 'visible'
+        parts = []
+        for step in steps:
+            part = await loop.run_in_executor(self.executor, step)
+            if generation != self.generation:   # superseded meanwhile
+                return
+            parts.append(part)
+            self.progress.value = len(parts)
+            done = len(parts) == len(steps)
+            self._discard = None if done else discard
+            deliver(parts, done)
+        self.progress.layout.visibility = 'hidden'
+        self._task = None
+
+
+def new_board(dashboard, fig):
+    """
+
+    @param dashboard: name of the dashboard, e.g 'sub'
+    @param fig: the dashboard's figure
+    @return: a new AsyncBoard for the dashboard, the fit still running on
+    its previous board (e.g of a re-run cell) is dropped
+    """
+    if dashboard in BOARDS:
+        BOARDS[dashboard].cancel()
+    BOARDS[dashboard] = AsyncBoard(fig)
+    return BOARDS[dashboard]
+
+
+@profiling.profiled()
+def sub_board(board, name, trial_start, block_start, trial_end, block_end):
     if (not trial_end and not block_end) or \
             (trial_start==trial_end and block_start==block_end): # stochastic cases
-        sig = EEGSignal(name, trial=trial_start, block=block_start)
-        name = f'{sig.name}|{sig.trial + 1}|{sig.block + 1}'
+        trials, blocks = trial_start, block_start
     else:
         if (block_start==block_end) or (not block_end):
-            erp = ERPSignal(name, (trial_start, trial_end), block_start)
-            name = f'{erp.name}|{erp.trial_start + 1}-{erp.trial_end + 1}|{erp.block + 1}'
+            trials, blocks = (trial_start, trial_end), block_start
         elif (trial_start==trial_end) or (not trial_end):
-            erp = ERPSignal(name, trial_start, (block_start,block_end))
-            name = f'{erp.name}|{erp.trial+1}|{erp.block_start+1}-{erp.block_end+1}'
+            trials, blocks = trial_start, (block_start, block_end)
         else:
-            erp = ERPSignal(name, (trial_start,trial_end), (block_start,block_end))
-            name = f'{erp.name}|{erp.trial_start+1}-{erp.trial_end+1}|{erp.block_start+1}-{erp.block_end+1}'
-        sig = erp.fit()
+            trials, blocks = (trial_start, trial_end), (block_start, block_end)
 
-    gos = sig.get_gos(name=name)
-    fig.add_trace(gos)
-    fig.show()
+    key = ('sub', mat_data.key, name, trials, blocks)
+    label = f'{name}|{plot.range_label(trials)}|{plot.range_label(blocks)}'
 
+    def draw(sig):
+        gos = sig.get_gos(name=label)
+        # only the new trace is sent to the FigureWidget's frontend
+        plot.add_lod_trace(board.fig, gos, sig.timeline, sig.values,
+                           sig.noise)
 
-def group_board(fig, group, trial_start, block_start, trial_end, block_end,
+    sig = FIT_CACHE.get(key)
+    if sig is not None:
+        board.cancel()      # an older fit must not land after it
+        draw(sig)
+        return
+
+    def deliver(parts, done):
+        FIT_CACHE.put(key, parts[0])
+        draw(parts[0])
+
+    board.submit([partial(fit_sub, name, trials, blocks)], deliver)
+
+
+@profiling.profiled()
+def group_board(board, group, trial_start, block_start, trial_end, block_end,
                 color, linestyle):
     if (not trial_end) or (trial_start==trial_end):
         trials = trial_start
-        trial_name = trial_start
     else:
         trials = (trial_start, trial_end)
-        trial_name = f'{trial_start}-{trial_end}'
     if (not block_end) or (block_start==block_end):
         blocks = block_start
-        block_name = block_start
     else:
         blocks = (block_start, block_end)
-        block_name = f'{block_start}-{block_end}'
 
-    grouped = GroupSignal(group, trials, blocks)
-    sig = grouped.fit()
-    name = f'{group}|{trial_name}|{block_name}'
+    key = ('group', mat_data.key, group, trials, blocks)
+    label = f'{group}|{plot.range_label(trials)}|{plot.range_label(blocks)}'
 
     rgb = plot.name_to_rgb(color)   # color
-    gos = sig.get_gos(name=name,    # title in legend and hovering
-                      line_color=plot.read_rgb(rgb),
-                      line_dash=linestyle,
-                      error_y_color=plot.read_rgb(rgb, error=True),
-                      hovertemplate='<b>%{y:.3f}</b>' +     # format of hover
-                                    f'<sub>{plot.MICROVOLT_STR}</sub>')
+    style = dict(line_color=plot.read_rgb(rgb),
+                 line_dash=linestyle,
+                 error_y_color=plot.read_rgb(rgb, error=True),
+                 hovertemplate='<b>%{y:.3f}</b>' +     # format of hover
+                               f'<sub>{plot.MICROVOLT_STR}</sub>')
+    fig = board.fig
+
+    sig = FIT_CACHE.get(key)
+    if sig is not None:
+        board.cancel()      # an older fit must not land after it
+        gos = sig.get_gos(name=label, **style)  # title in legend and hovering
+        # only the new trace is sent to the FigureWidget's frontend
+        plot.add_lod_trace(fig, gos, sig.timeline, sig.values, sig.noise)
+        return
+
+    steps, finish = group_fit_steps(group, trials, blocks)
+    n_subjects = len(subject_index(mat_data).group(group))
+    uid = []    # of the request's trace, added with its first part
+
+    def deliver(parts, done):
+        sig = finish(parts)
+        name = label
+        if done:
+            FIT_CACHE.put(key, sig)
+        else:   # the average of the subjects fitted so far
+            fitted = sum(len(vals) for vals, _ in parts)
+            name = f'{label} ({fitted}/{n_subjects})'
+        if not uid:
+            gos = sig.get_gos(name=name, **style)
+            uid.append(plot.add_lod_trace(fig, gos, sig.timeline, sig.values,
+                                          sig.noise))
+        else:
+            plot.update_lod_trace(fig, uid[0], sig.timeline, sig.values,
+                                  sig.noise, name=name)
 
-    fig.add_trace(gos)
-    fig.show()
+    board.submit(steps, deliver,
+                 discard=lambda: plot.remove_lod_trace(fig, uid[0]))
 
 
 def dash_sub():
-    fig = plot.init_trial()
+    widgets.load_options()
+    fig = plot.init_trial(widget=True, timeline=time_axis(mat_data))
+    plot.enable_zoom_lod(fig)
     title_text = "Subject Dynamic Within a Given Block-trial Ranges"
     fig.update_layout(title={
         'y': 0.9,
@@ -70,18 +282,19 @@ def dash_sub():
         font={'family': 'Arial'},
         legend_title_text='Sub | Trials | Blocks')
 
-    out = interactive(sub_board, {'manual': True},
-                                 fig=fixed(fig),
-                                 name=widgets.sub_name_dropdown,
-                                 trial_start=widgets.trial_start_slider,
-                                 block_start=widgets.block_start_slider,
-                                 trial_end=widgets.trial_end_slider,
-                                 block_end=widgets.block_end_slider)
-    return out
+    board = new_board('sub', fig)
+    query = widgets.query_widgets('name')
+    # a fit still running for the previous values is dropped
+    board.watch(*query.values())
+    out = interactive(sub_board, {'manual': True}, board=fixed(board),
+                      **query)
+    return VBox([out, board.progress, fig])
 
 
 def dash_group():
-    fig = plot.init_trial()
+    widgets.load_options()
+    fig = plot.init_trial(widget=True, timeline=time_axis(mat_data))
+    plot.enable_zoom_lod(fig)
     title_text = "Group Dynamic Within a Given Block-trial Ranges"
     fig.update_layout(
         title={
@@ -94,13 +307,13 @@ def dash_group():
         legend_title_text='Group|Trials|Blocks',
         hovermode='x unified')
 
+    board = new_board('group', fig)
+    query = widgets.query_widgets('group')
+    # a fit still running for the previous values is dropped
+    board.watch(*query.values())
     out = interactive(group_board, {'manual': True, 'manual_name': 'Plot'},
-                      fig=fixed(fig),
-                      group=widgets.group_name_dropdown,
-                      trial_start=widgets.trial_start_slider,
-                      block_start=widgets.block_start_slider,
-                      trial_end=widgets.trial_end_slider,
-                      block_end=widgets.block_end_slider,
+                      board=fixed(board),
                       color=widgets.color,
-                      linestyle=widgets.linestyle)
-    return out
+                      linestyle=widgets.linestyle,
+                      **query)
+    return VBox([out, board.progress, fig])
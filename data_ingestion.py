@@ -4,21 +4,34 @@ import numpy as np
 import json
 import chardet
 import re
+import codecs
 import os
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from cube import SummaryCube, range_bounds
+import profiling
 
 
 class MatIngest:
     '''
-    Ingestion of Matlab Structure into Python using scipy.io
+    Ingestion of Matlab Structure into Python. Classic .mat files are read
+    with scipy.io, MATLAB v7.3 (HDF5) files are opened lazily with h5py and
+    store folders written by write_store are opened with zero copy.
 
     ...
 
     Attributes
     ----------
     filename: str
-        path to .mat file
+        path to .mat file, or to a store folder
     data_name: str
-        the name where the data is (e.g "Data_All")
+        the name where the data is (e.g "Data_All"), ignored for a store
+    mmap_mode: str
+        numpy mmap mode for opening a store's arrays
+    backend: str
+        one of {'mat', 'hdf5', 'store'}
 
     Methods
     -------
@@ -26,27 +39,505 @@ class MatIngest:
         creates a Python Dict object represents the Matlab Structure
     '''
 
-    def __init__(self, filename, data_name):
-        self.file = sio.loadmat(filename,
-                                struct_as_record=False, squeeze_me=True)
-        self.struct = self.file[data_name]
+    def __init__(self, filename, data_name=None, mmap_mode='r'):
+        self.filename = filename
+        self.mmap_mode = mmap_mode
+        if is_store(filename):
+            self.backend = 'store'
+            self.file, self.struct = None, None
+        elif is_mat73(filename):
+            self.backend = 'hdf5'
+            self.file = open_h5(filename)
+            self.struct = self.file[data_name]
+        else:
+            self.backend = 'mat'
+            self.file = sio.loadmat(filename,
+                                    struct_as_record=False, squeeze_me=True)
+            self.struct = self.file[data_name]
 
+    @profiling.profiled()
     def create_data_obj(self):
         """
 
-        :return: a Dict contains Matlab Structure
+        :return: a Dict contains Matlab Structure. For v7.3 files, large
+        numeric fields are H5Array proxies read on slicing
         """
+        if self.backend == 'store':
+            return read_store(self.filename, mmap_mode=self.mmap_mode)
         struct = self.struct
         d = {}
-        for attr in struct._fieldnames:
-            d[attr] = getattr(struct, attr)
+        if self.backend == 'hdf5':
+            for attr in struct.keys():
+                d[attr] = read_h5_field(self.file, struct[attr])
+        else:
+            for attr in struct._fieldnames:
+                d[attr] = getattr(struct, attr)
+        valid = valid_epochs(d['s2'])
         # next line defined 2d-array: rows are empty signals and columns are
         # sub_id, trial, block
-        d['null'] = np.argwhere(np.all(
-            np.isnan(d['s2']), axis=1))
+        d['null'] = np.argwhere(~valid)
+        d['index'] = SubjectIndex(d['subjects'], d['group'])
+        d['epochs'] = EpochIndex(valid)
+        d['timeline'] = Timeline(d['time'])
         return d
 
 
+@profiling.profiled()
+def valid_epochs(s2, chunk=8):
+    """
+
+    @param s2: eeg tensor (subjects, time, trials, blocks), array or proxy
+    @param chunk: number of subjects read at once
+    @return: bool np array (subjects, trials, blocks), False for all-NaN
+    signals
+    """
+    valid = np.empty((s2.shape[0],) + tuple(s2.shape[2:]), dtype=bool)
+    for start in range(0, s2.shape[0], chunk):
+        x = np.asarray(s2[start:start + chunk])
+        # only epochs starting with NaN may be all-NaN, scan just those
+        part = ~np.isnan(x[:, 0])
+        empty = np.nonzero(~part)
+        part[empty] = ~np.all(
+            np.isnan(x[(empty[0], slice(None)) + empty[1:]]), axis=1)
+        valid[start:start + len(part)] = part
+    return valid
+
+
+class ArrayProxy:
+    '''
+    Base of read-only array proxies, objects with an array's shape and dtype
+    whose data is produced only for the requested slice. Subclasses
+    implement __getitem__ for basic and (single axis) fancy indexing.
+    '''
+    shape = ()
+    dtype = np.dtype(float)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        raise NotImplementedError
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+
+def is_mat73(filename):
+    """
+
+    @param filename: path to .mat file
+    @return: True if the file is a MATLAB v7.3 (HDF5 based) .mat file
+    """
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        header = f.read(128)
+    return header.startswith(b'MATLAB 7.3')
+
+
+def open_h5(filename):
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Reading MATLAB v7.3 files requires h5py "
+                          "(pip install h5py)")
+    return h5py.File(filename, 'r')
+
+
+# fields smaller than this (number of elements) are read eagerly
+H5_EAGER_SIZE = 2 ** 20
+
+
+def read_h5_field(h5file, node):
+    """
+Read one field of a v7.3 MATLAB structure, the way scipy.io.loadmat does
+with squeeze_me=True. Large numeric fields are returned as H5Array proxies.
+    @param h5file: open h5py.File
+    @param node: h5py Dataset or Group of the field
+    @return: value of the field
+    """
+    if not hasattr(node, 'dtype'):   # nested structure
+        return {k: read_h5_field(h5file, node[k]) for k in node.keys()}
+    matlab_class = node.attrs.get('MATLAB_class', b'')
+    if isinstance(matlab_class, bytes):
+        matlab_class = matlab_class.decode()
+    if matlab_class == 'char':
+        return h5_char(node[()])
+    if matlab_class == 'cell':
+        cells = np.empty(node.shape, dtype=object)
+        for idx, ref in np.ndenumerate(node[()]):
+            cells[idx] = read_h5_field(h5file, h5file[ref])
+        return np.squeeze(cells.T)
+    if node.size > H5_EAGER_SIZE:
+        return H5Array(node)
+    out = np.squeeze(np.asarray(node[()]).T)
+    if matlab_class == 'logical':
+        out = out.astype(bool)
+    return out[()] if out.ndim == 0 else out
+
+
+def h5_char(codes):
+    return ''.join(map(chr, np.asarray(codes).flatten(order='F')))
+
+
+class H5Array(ArrayProxy):
+    '''
+    Lazy proxy of a numeric dataset in a v7.3 .mat file. Exposes the MATLAB
+    axes order (h5py sees them reversed), and reads only the hyperslab of
+    a requested slice.
+
+    ...
+
+    Attributes
+    ----------
+    dataset: h5py.Dataset
+        the proxied dataset
+    '''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.shape = dataset.shape[::-1]
+        self.dtype = dataset.dtype
+
+    def __getitem__(self, key):
+        key = expand_key(key, self.ndim)
+        has_array = any(isinstance(k, np.ndarray) for k in key)
+        h5_key, post_key = [], []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, np.ndarray):
+                k = np.where(k < 0, k + n, k)
+            elif not isinstance(k, slice) and k < 0:
+                k += n
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step > 0:
+                    h5_key.append(slice(start, max(start, stop), step))
+                    post_key.append(slice(None))
+                else:   # h5py can't step backwards, read all and flip
+                    h5_key.append(slice(None))
+                    post_key.append(k)
+            elif isinstance(k, np.ndarray):
+                # read the bounding hyperslab, numpy applies the fancy index
+                lo = int(k.min()) if k.size else 0
+                hi = int(k.max()) + 1 if k.size else 0
+                h5_key.append(slice(lo, hi))
+                post_key.append(k - lo)
+            elif has_array:   # keep int axes for numpy's fancy semantics
+                h5_key.append(slice(k, k + 1))
+                post_key.append(0)
+            else:
+                h5_key.append(k)
+        out = np.asarray(self.dataset[tuple(h5_key[::-1])]).T
+        if any(not isinstance(k, slice) or k != slice(None) for k in post_key):
+            out = out[tuple(post_key)]
+        return out
+
+
+def expand_key(key, ndim):
+    """
+
+    @param key: numpy index
+    @param ndim: number of dimensions of the indexed array
+    @return: tuple of ndim elements of int, slice or int np array
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is None for k in key):
+        raise IndexError("np.newaxis is not supported by array proxies")
+    if any(k is Ellipsis for k in key):
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    key = key + (slice(None),) * (ndim - len(key))
+    out = []
+    for k in key:
+        if isinstance(k, (list, np.ndarray)):
+            k = np.asarray(k)
+            k = np.flatnonzero(k) if k.dtype == bool else k.astype(np.intp)
+        elif not isinstance(k, slice):
+            k = int(k)
+        out.append(k)
+    return tuple(out)
+
+
+STORE_META = 'meta.pkl'
+# storage dtypes of s2 in a store, int16 is quantized (see quantize)
+STORAGE_DTYPES = ('float64', 'float32', 'int16')
+QUANTIZED_DTYPE = np.dtype(np.int16)
+# code of missing (NaN) values in quantized arrays
+QUANTIZED_NAN = np.iinfo(np.int16).min
+QUANTIZED_MAX = np.iinfo(np.int16).max
+
+
+def quantize_params(x):
+    """
+Parameters of a linear int16 quantization per item of the first axis (per
+subject of s2), spanning the item's min-max range. The absolute error of
+a dequantized value is at most scale / 2, i.e the item's range / 131068
+(e.g 0.0015 uV for a range of +-100 uV).
+    @param x: float np array
+    @return: (scale, offset), float64 np arrays of len(x)
+    """
+    axes = tuple(range(1, np.ndim(x)))
+    # fmin/fmax skip NaN without warning on all-NaN items
+    lo, hi = np.fmin.reduce(x, axis=axes), np.fmax.reduce(x, axis=axes)
+    offset = np.where(np.isnan(lo), 0, (hi.astype(np.float64) + lo) / 2)
+    scale = (hi.astype(np.float64) - lo) / (2 * QUANTIZED_MAX)
+    scale = np.where(np.isnan(scale) | (scale == 0), 1, scale)
+    return scale, offset
+
+
+def quantize(x, scale, offset):
+    """
+
+    @param x: float np array
+    @param scale, offset: see quantize_params
+    @return: int16 codes of x, where x ~ codes * scale + offset, NaN is
+    coded as QUANTIZED_NAN
+    """
+    shape = (-1,) + (1,) * (np.ndim(x) - 1)
+    codes = np.rint((x - offset.reshape(shape)) / scale.reshape(shape))
+    np.clip(codes, -QUANTIZED_MAX, QUANTIZED_MAX, out=codes)
+    codes[np.isnan(codes)] = QUANTIZED_NAN
+    return codes.astype(QUANTIZED_DTYPE)
+
+
+class QuantizedArray(ArrayProxy):
+    '''
+    Proxy of an int16 quantized array (see quantize), typically memory-mapped
+    from a store: a quarter of the float64 size in RAM, on disk and in the
+    page cache. Slices are dequantized to float32, with NaN for missing
+    values.
+
+    ...
+
+    Attributes
+    ----------
+    codes: np array
+        int16 codes
+    scale, offset: np array
+        dequantization parameters per item of the first axis
+    '''
+
+    def __init__(self, codes, scale, offset, dtype=np.float32):
+        self.codes = codes
+        self.shape = codes.shape
+        self.dtype = np.dtype(dtype)
+        shape = (-1,) + (1,) * (codes.ndim - 1)
+        self.scale = np.asarray(scale, dtype=self.dtype).reshape(shape)
+        self.offset = np.asarray(offset, dtype=self.dtype).reshape(shape)
+
+    def __getitem__(self, key):
+        codes = np.asarray(self.codes[key])
+        # the parameters indexed like the codes, without materializing them
+        scale = np.broadcast_to(self.scale, self.shape)[key]
+        offset = np.broadcast_to(self.offset, self.shape)[key]
+        out = np.asarray(codes.astype(self.dtype) * scale + offset)
+        out[codes == QUANTIZED_NAN] = np.nan
+        return out[()] if out.ndim == 0 else out
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, STORE_META))
+
+
+def write_array(filename, value, dtype=None, chunk=8):
+    """
+Stream an array (or proxy) into a C ordered .npy file chunk by chunk, so it
+doesn't have to fit in RAM twice. Fortran ordered arrays (as loadmat returns
+them) are transposed chunk by chunk, so that an item of the first axis (a
+subject of s2) is contiguous in the file.
+    @param filename: destination .npy file
+    @param value: np array or ArrayProxy
+    @param dtype: storage dtype, None to keep value's. int16 quantizes the
+    array (see quantize_params)
+    @param chunk: number of items of the first axis written at once
+    @return: (scale, offset) of a quantized array, None otherwise
+    """
+    dtype = np.dtype(value.dtype if dtype is None else dtype)
+    quantized = dtype == QUANTIZED_DTYPE
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                    shape=value.shape)
+    # chunks of whole items, their quantization parameters are final
+    params = []
+    for start in range(0, value.shape[0], chunk):
+        part = np.asarray(value[start:start + chunk])
+        if quantized:
+            params.append(quantize_params(part))
+            part = quantize(part, *params[-1])
+        out[start:start + len(part)] = part
+    out.flush()
+    del out
+    if quantized:
+        return tuple(np.concatenate(p) for p in zip(*params))
+    return None
+
+
+@profiling.profiled()
+def write_store(data_obj, path, s2_dtype=None):
+    """
+Write a data object into a memory-mappable folder: every numeric array
+(s2, time, null...) is saved as its own .npy file, the rest (subjects,
+group and other object fields) is pickled into one metadata file.
+    @param data_obj: data object, as returned by MatIngest.create_data_obj
+    @param path: destination folder
+    @param s2_dtype: storage dtype of s2, one of STORAGE_DTYPES, None to
+    keep its dtype. float32 keeps ~7 significant digits, int16 is quantized
+    per subject (see quantize) and read back as a QuantizedArray
+    """
+    if s2_dtype is not None and s2_dtype not in STORAGE_DTYPES:
+        raise ValueError(f"incorrect storage dtype: {s2_dtype}, "
+                         f"allowed are {STORAGE_DTYPES}")
+    os.makedirs(path, exist_ok=True)
+    meta = {'arrays': [], 'fields': {}, 'quantized': {}}
+    for key, value in data_obj.items():
+        filename = os.path.join(path, f'{key}.npy')
+        if key == 's2':
+            # subject-major whatever the order of the ingested s2
+            params = write_array(filename, value, s2_dtype)
+            if params is not None:
+                meta['quantized'][key] = params
+            meta['arrays'].append(key)
+        elif isinstance(value, ArrayProxy):
+            # stream proxies chunk by chunk, they may not fit in RAM
+            write_array(filename, value)
+            meta['arrays'].append(key)
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            np.save(filename, value)
+            meta['arrays'].append(key)
+        else:
+            meta['fields'][key] = value
+    # metadata is written last (aside and renamed), it marks the store as
+    # complete
+    filename = os.path.join(path, STORE_META)
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+
+def read_store(path, mmap_mode='r'):
+    """
+
+    @param path: store folder written by write_store
+    @param mmap_mode: numpy mmap mode of the arrays, None loads them to RAM
+    @return: data object whose arrays are memory-mapped from the store
+    (quantized arrays are QuantizedArray proxies of their memory-mapped
+    codes)
+    """
+    with open(os.path.join(path, STORE_META), 'rb') as f:
+        meta = pickle.load(f)
+    d = dict(meta['fields'])
+    quantized = meta.get('quantized', {})
+    for key in meta['arrays']:
+        d[key] = np.load(os.path.join(path, f'{key}.npy'),
+                         mmap_mode=mmap_mode)
+        if key in quantized:
+            d[key] = QuantizedArray(d[key], *quantized[key])
+    return d
+
+
+def convert_mat(filename, data_name, path):
+    """
+Convert a .mat file into a store folder, to be opened by MatIngest later
+    @param filename: path to .mat file
+    @param data_name: the name where the data is (e.g "Data_All")
+    @param path: destination folder
+    """
+    write_store(MatIngest(filename, data_name).create_data_obj(), path)
+
+
+# E-Prime writes UTF-16LE logs, a prefix this long is enough to tell them
+ENCODING_SAMPLE_SIZE = 4096
+BOMS = ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16'))
+
+
+def detect_encoding(bin_data, sample_size=ENCODING_SAMPLE_SIZE):
+    """
+Detect the encoding of a text file from its BOM, or else from a prefix
+sample: zero bytes at odd (even) positions mean UTF-16LE (BE), otherwise
+chardet decides on the sample only.
+    @param bin_data: file content (bytes)
+    @param sample_size: number of leading bytes examined
+    @return: encoding name
+    """
+    for bom, encoding in BOMS:
+        if bin_data.startswith(bom):
+            return encoding
+    sample = bin_data[:sample_size]
+    half = len(sample) // 2
+    if half:
+        odd_zeros = sample[1::2].count(0) / half
+        even_zeros = sample[0::2].count(0) / half
+        if odd_zeros > 0.3 and even_zeros < 0.05:
+            return 'utf-16-le'
+        if even_zeros > 0.3 and odd_zeros < 0.05:
+            return 'utf-16-be'
+    return chardet.detect(sample)['encoding'] or 'utf-8'
+
+
+class EPrimePatterns:
+    '''
+    Regex engine of the E-Prime fields: compiles the configured patterns once
+    (e.g once per BehaveIngest) and extracts all meta and data fields of a
+    text in one call.
+
+    Fields are scanned one pattern at a time on purpose: joining them into
+    one alternation regex defeats re's literal-prefix search and measured
+    2-50x slower than separate scans.
+
+    ...
+
+    Attributes
+    ----------
+    patterns: dict
+        nested dict of raw patterns, see EPrime
+    compiled: dict
+        same nesting, compiled patterns
+
+    Methods
+    -------
+    scan
+        extracts all fields from decoded text
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.compiled = {field_type: {field: re.compile(pat)
+                                      for field, pat in fields.items()}
+                         for field_type, fields in patterns.items()}
+
+    @profiling.profiled()
+    def scan(self, text):
+        """
+
+        @param text: decoded E-Prime text
+        @return: dict (field_type, field) -> value, where a meta value is
+        its first match (None if not found) and a data value is a list as
+        re.findall returns it
+        """
+        out = {}
+        for field, pat in self.compiled.get('meta', {}).items():
+            match = pat.search(text)
+            out['meta', field] = match.group() if match else None
+        for field, pat in self.compiled.get('data', {}).items():
+            out['data', field] = pat.findall(text)
+        return out
+
+
 class EPrime:
     '''
     Parser of txt file represents E-Prime behavioural data (files from
@@ -58,20 +549,38 @@ class EPrime:
     ----------
     filename: str
         path to E-Prime txt file consisting behavioural data
-    patterns: dict
+    patterns: dict or EPrimePatterns
         nested dict: 2nd level keys are 'meta' and 'data', each of them
         consist regex patterns for extract meta data or RT data (respectively)
-        from E-Prime files.
+        from E-Prime files. Pass an EPrimePatterns to share compiled patterns
+        between files.
+    encoding: str
+        encoding of the file, None to detect it (see detect_encoding)
     '''
 
-    def __init__(self, filename, patterns):
+    def __init__(self, filename, patterns, encoding=None):
         self.filename = filename
         with open(filename, 'rb') as f:
             bin_data = f.read()
-            encoding = chardet.detect(bin_data)['encoding']
+            if encoding is None:
+                encoding = detect_encoding(bin_data)
             self.decoded = bin_data.decode(encoding)
-        self.patterns = patterns
+        if not isinstance(patterns, EPrimePatterns):
+            patterns = EPrimePatterns(patterns)
+        self.engine = patterns
+        self.patterns = patterns.patterns
+        self.__fields = None
+
+    @property
+    def fields(self):
+        """
+All fields of the file, extracted in one scan on first use
+        """
+        if self.__fields is None:
+            self.__fields = self.engine.scan(self.decoded)
+        return self.__fields
 
+    @profiling.profiled()
     def field_parser(self, field, field_type):
         """
 
@@ -80,16 +589,13 @@ class EPrime:
         @return: eprime metadata value for meta field, or eprime trial/block
         values for data fields
         """
-        pat = self.patterns[field_type][field]
         if field_type == "meta":
-            try:
-                out = re.compile(pat).search(self.decoded).group()
-            except AttributeError:
+            out = self.fields[field_type, field]
+            if out is None:
                 print(f'field: {field} has no match in {self.filename}')
-                out = None
 
         elif field_type == "data":
-            out = re.compile(pat).findall(self.decoded)
+            out = self.fields[field_type, field]
             if out == []:
                 out = None
 
@@ -120,6 +626,26 @@ class EPrime:
 
         return rts
 
+    def parse(self):
+        """
+
+        @return: (subject name, (340,) np array of RT's), from a single read
+        and decode of the file
+        """
+        return self.field_parser("Name", "meta"), self.extract_trial_rts()
+
+
+def parse_eprime(filename, patterns, encoding=None):
+    """
+Module level EPrime.parse, so it can be sent to worker processes
+    @param filename: path to E-Prime txt file
+    @param patterns: see EPrime
+    @param encoding: see EPrime
+    @return: (subject name, np array of RT's)
+    """
+    return EPrime(filename=filename, patterns=patterns,
+                  encoding=encoding).parse()
+
 
 class BehaveIngest:
     '''
@@ -135,15 +661,20 @@ class BehaveIngest:
     patterns: dict
         nested dict: 2nd level keys are 'meta' and 'data', each of them
         consist regex patterns for extract meta data or RT data (respectively)
-        from E-Prime files.
+        from E-Prime files. Compiled once for all the files.
+    encoding: str
+        encoding of the files, None to detect it per file
     '''
-    def __init__(self, path, patterns):
+    def __init__(self, path, patterns, encoding=None):
         self.path = path
         self.files = []
         for fn in os.listdir(path):
             if fn.endswith('.txt'):
                 self.files.append(fn)
+        if not isinstance(patterns, EPrimePatterns):
+            patterns = EPrimePatterns(patterns)
         self.patterns = patterns
+        self.encoding = encoding
 
     def get_subjects(self):
         """
@@ -153,7 +684,7 @@ class BehaveIngest:
         id_lst = []
         for fn in self.files:
             parser = EPrime(filename=os.path.join(self.path,fn),
-                            patterns=self.patterns)
+                            patterns=self.patterns, encoding=self.encoding)
             id_lst.append(parser.field_parser("Name", "meta"))
         return np.array(id_lst)
 
@@ -166,10 +697,177 @@ class BehaveIngest:
         rt_lst = []
         for fn in self.files:
             parser = EPrime(filename=os.path.join(self.path,fn),
-                            patterns=self.patterns)
+                            patterns=self.patterns, encoding=self.encoding)
             rt_lst.append(parser.extract_trial_rts())
         return np.stack(rt_lst)
 
+    @profiling.profiled()
+    def ingest(self, workers=None):
+        """
+Parse every file once, for both its subject and its RT's. Files are fanned
+out over a process pool.
+        @param workers: number of worker processes, None for one per CPU,
+        1 parses serially in this process
+        @return: (1-d np array of subjects, np ndarray of RT's of shape
+        (num_of subjects, num of trials in experiment))
+        """
+        results = self.parse_files(self.files, workers)
+        id_lst = [sub for sub, _ in results]
+        rt_lst = [rts for _, rts in results]
+        return np.array(id_lst), np.stack(rt_lst)
+
+    @profiling.profiled()
+    def refresh(self, manifest, workers=None):
+        """
+Like ingest, but parses only files that are new or changed since they were
+recorded in the manifest, and merges them with the recorded ones.
+        @param manifest: BehaveManifest of the folder, updated and saved
+        @param workers: see ingest
+        @return: see ingest
+        """
+        manifest.validate(self.patterns.patterns, self.encoding)
+        stale = [fn for fn in self.files
+                 if not manifest.is_fresh(os.path.join(self.path, fn))]
+        for fn, result in zip(stale, self.parse_files(stale, workers)):
+            manifest.record(os.path.join(self.path, fn), *result)
+        manifest.prune([os.path.join(self.path, fn) for fn in self.files])
+        if stale or manifest.changed:
+            manifest.save()
+        results = [manifest.lookup(os.path.join(self.path, fn))
+                   for fn in self.files]
+        id_lst = [sub for sub, _ in results]
+        rt_lst = [rts for _, rts in results]
+        return np.array(id_lst), np.stack(rt_lst)
+
+    @profiling.profiled()
+    def parse_files(self, files, workers=None):
+        """
+
+        @param files: file names in the folder
+        @param workers: see ingest
+        @return: list of (subject, RT's) of the files, in the same order
+        """
+        filenames = [os.path.join(self.path, fn) for fn in files]
+        if workers == 1 or len(filenames) < 2:
+            return [parse_eprime(fn, self.patterns, self.encoding)
+                    for fn in filenames]
+        workers = min(workers or os.cpu_count() or 1, len(filenames))
+        chunksize = max(1, len(filenames) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(parse_eprime, filenames,
+                                 repeat(self.patterns),
+                                 repeat(self.encoding),
+                                 chunksize=chunksize))
+
+
+class BehaveManifest:
+    '''
+    Record of already parsed E-Prime files: for each file its size, mtime,
+    content hash and parsed subject and RT's, saved as JSON. A file whose
+    size and mtime (or, failing that, content hash) didn't change is not
+    parsed again.
+
+    ...
+
+    Attributes
+    ----------
+    filename: str
+        path to the JSON manifest
+    entries: dict
+        absolute file path -> record
+    changed: bool
+        whether entries changed since loaded
+
+    Methods
+    -------
+    validate
+        drops all entries if they were parsed with other patterns/encoding
+    is_fresh
+        whether a file's record is up to date
+    record, lookup, prune
+        add, read and remove records
+    save
+        writes the manifest
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries, self.parser_key = {}, None
+        if os.path.exists(filename):
+            with open(filename, 'r') as jf:
+                doc = json.load(jf)
+            self.entries, self.parser_key = doc['entries'], doc['parser']
+        self.changed = False
+
+    def validate(self, patterns, encoding=None):
+        """
+
+        @param patterns: dict of E-Prime patterns the files are parsed with
+        @param encoding: encoding the files are parsed with
+        """
+        parser_key = hashlib.sha1(json.dumps(
+            [patterns, encoding], sort_keys=True).encode()).hexdigest()
+        if parser_key != self.parser_key:
+            self.entries, self.parser_key = {}, parser_key
+            self.changed = True
+
+    def is_fresh(self, path):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None:
+            return False
+        st = os.stat(path)
+        if (entry['size'], entry['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+            return True
+        # touched but maybe not changed, compare content
+        if entry['sha1'] == file_sha1(path):
+            entry['size'], entry['mtime_ns'] = st.st_size, st.st_mtime_ns
+            self.changed = True
+            return True
+        return False
+
+    def record(self, path, subject, rts):
+        st = os.stat(path)
+        self.entries[os.path.abspath(path)] = {
+            'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+            'sha1': file_sha1(path), 'subject': subject,
+            'rts': rts.tolist()}
+        self.changed = True
+
+    def lookup(self, path):
+        """
+
+        @return: (subject, np array of RT's) recorded for the file
+        """
+        entry = self.entries[os.path.abspath(path)]
+        return entry['subject'], np.array(entry['rts'], dtype=float)
+
+    def prune(self, paths):
+        """
+
+        @param paths: files that still exist, others' records are removed
+        """
+        keep = {os.path.abspath(path) for path in paths}
+        for path in list(self.entries):
+            if path not in keep:
+                del self.entries[path]
+                self.changed = True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        with open(self.filename + '.tmp', 'w') as jf:
+            json.dump({'parser': self.parser_key, 'entries': self.entries},
+                      jf)
+        os.replace(self.filename + '.tmp', self.filename)
+        self.changed = False
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
 
 # # function to get Control/Asd subject's idx
 # def get_groups_idx(data, cont_name='Control', asd_name='ASD',
@@ -178,6 +876,290 @@ class BehaveIngest:
 #     asd_ind = np.where(data[label_name]==asd_name)[0]
 #     return {cont_name:cont_ind, asd_name:asd_ind}
 
+class SubjectIndex:
+    '''
+    Hash index of the data object's subjects, built once at ingestion:
+    subject name -> row of s2, group -> rows, and translation of other
+    id lists (e.g E-Prime's) to the data's subject names.
+
+    ...
+
+    Attributes
+    ----------
+    subjects: np array
+        subject names, by row
+    name_rows: dict
+        subject name -> its (first) row
+    group_rows: dict
+        group name -> int np array of its rows
+
+    Methods
+    -------
+    row, rows, group
+        lookups of subjects and groups rows
+    translate
+        maps ids through an id_map
+    align
+        vectorized join of per-id records onto the subjects rows
+    '''
+
+    def __init__(self, subjects, groups):
+        self.subjects = np.asarray(subjects)
+        self.name_rows = {}
+        for i, name in enumerate(self.subjects):
+            self.name_rows.setdefault(name, i)
+        groups = np.asarray(groups)
+        self.group_rows = {g: np.flatnonzero(groups == g)
+                           for g in np.unique(groups)}
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def row(self, name):
+        return self.name_rows[name]
+
+    def rows(self, names):
+        """
+
+        @param names: subject names
+        @return: int np array of their rows, -1 for unknown names
+        """
+        return np.array([self.name_rows.get(name, -1) for name in names],
+                        dtype=np.intp)
+
+    def group(self, group):
+        return self.group_rows.get(group, np.array([], dtype=np.intp))
+
+    @staticmethod
+    def translate(ids, id_map):
+        """
+Adjust subjects from ids to their id_map mapping,
+keep 'not mapped' ids as they are.
+        @param ids: subjects to convert
+        @param id_map: mapping to other ids list
+        @return: converted ids array
+        """
+        return np.array([id_map.get(sub_id, sub_id) for sub_id in ids])
+
+    def align(self, ids, values, fill=np.nan):
+        """
+Join records given by id onto the subjects rows (first record of an id
+wins, subjects without a record are filled).
+        @param ids: ids of the records, in subject names terms
+        @param values: np array of records, first axis matches ids
+        @param fill: value of subjects without a record
+        @return: np array of shape (len(subjects),) + values.shape[1:]
+        """
+        values = np.asarray(values)
+        out = np.full((len(self),) + values.shape[1:], fill,
+                      dtype=np.result_type(values, fill))
+        rows = self.rows(ids)
+        found = np.flatnonzero(rows >= 0)
+        # first record of each row
+        rows, first = np.unique(rows[found], return_index=True)
+        out[rows] = values[found[first]]
+        return out
+
+
+def subject_index(data):
+    """
+
+    @param data: data object
+    @return: its SubjectIndex (built if the data object has none)
+    """
+    if 'index' in data:
+        return data['index']
+    return SubjectIndex(data['subjects'], data['group'])
+
+
+class EpochIndex:
+    '''
+    Validity index of the epochs of s2, built once at ingestion: a bitmap
+    of the (subject, trial, block) epochs that have any non-NaN value, and
+    its 2d prefix sums over trials and blocks, so the number of valid epochs
+    in any trial-block range is read from 4 corners per subject.
+
+    ...
+
+    Attributes
+    ----------
+    valid: np array
+        bool (subjects, trials, blocks), False for all-NaN epochs
+    counts: np array
+        (subjects, trials + 1, blocks + 1) prefix sums of valid
+
+    Methods
+    -------
+    mask
+        valid epochs of a query
+    count
+        number of valid epochs of a query
+    '''
+
+    def __init__(self, valid):
+        self.valid = np.asarray(valid, dtype=bool)
+        n_sub, n_trials, n_blocks = self.valid.shape
+        self.counts = np.zeros((n_sub, n_trials + 1, n_blocks + 1),
+                               dtype=np.int32)
+        self.counts[:, 1:, 1:] = self.valid.cumsum(axis=1).cumsum(axis=2)
+
+    def mask(self, rows, trial, block):
+        """
+
+        @param rows: subject row(s) of s2, int or int array
+        @param trial: trial index of s2, int or slice (step 1)
+        @param block: block index of s2, int or slice (step 1)
+        @return: bool np array, shaped like s2[rows, 0, trial, block]
+        """
+        return self.valid[rows][..., trial, block]
+
+    def count(self, rows, trial, block):
+        """
+
+        @return: number of valid epochs in the trial-block range, per row
+        (see mask for params)
+        """
+        t0, t1 = range_bounds(trial, self.valid.shape[1])
+        b0, b1 = range_bounds(block, self.valid.shape[2])
+        c = self.counts[rows]
+        return (c[..., t1, b1] - c[..., t0, b1] -
+                c[..., t1, b0] + c[..., t0, b0])
+
+
+def epoch_index(data):
+    """
+
+    @param data: data object
+    @return: its EpochIndex (built if the data object has none)
+    """
+    if 'epochs' in data:
+        return data['epochs']
+    return EpochIndex(valid_epochs(data['s2']))
+
+
+def nearest_index(timeline, t):
+    """
+Index of the timeline point nearest to t (the first one on ties), by binary
+search. Same as np.argmin(np.abs(timeline - t)) for a sorted timeline.
+    @param timeline: sorted 1-d np array
+    @param t: time or np array of times
+    @return: int or int np array
+    """
+    timeline = np.asarray(timeline)
+    t = np.asarray(t)
+    right = np.clip(np.searchsorted(timeline, t), 1, len(timeline) - 1)
+    left = right - 1
+    idx = np.where(np.abs(timeline[left] - t) <= np.abs(timeline[right] - t),
+                   left, right)
+    if len(timeline) == 1:
+        idx = np.zeros_like(idx)
+    return idx[()] if idx.ndim == 0 else idx
+
+
+class Timeline:
+    '''
+    The time axis of s2 (ms), built once at ingestion: ms <-> index lookups
+    by binary search, for scalars or arrays, and the extents of plots. Its
+    read-only times array is the timeline shared by the data's Signals and
+    Components (see analysis.default_timeline), a plain np array for
+    arithmetic and comparisons.
+
+    ...
+
+    Attributes
+    ----------
+    times: np array
+        read-only sorted times, in ms
+    step: float
+        median sampling interval, in ms
+    srate: float
+        sampling rate, in Hz
+
+    Methods
+    -------
+    index
+        index of the nearest time point
+    span
+        slice between the nearest points of two times
+    window
+        slice of the time points in [t1, t2)
+    '''
+
+    def __init__(self, times):
+        self.times = np.array(times, dtype=np.float64).ravel()
+        self.times.setflags(write=False)
+        diffs = np.diff(self.times)
+        self.step = float(np.median(diffs)) if len(diffs) else np.nan
+        self.srate = 1000 / self.step
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, key):
+        return self.times[key]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.times if dtype is None else self.times.astype(dtype)
+
+    def __repr__(self):
+        return (f'Timeline({self.extent[0]:g}..{self.extent[1]:g} ms, '
+                f'{len(self)} points, {self.srate:g} Hz)')
+
+    @property
+    def extent(self):
+        """
+
+        @return: (first, last) time, e.g the x range of a trial's figure
+        """
+        return float(self.times[0]), float(self.times[-1])
+
+    def index(self, t):
+        return nearest_index(self.times, t)
+
+    def span(self, t1, t2):
+        """
+
+        @return: slice from the point nearest t1 to the point nearest t2
+        (excluded), as Component windows a signal
+        """
+        i1, i2 = self.index([t1, t2])
+        return slice(int(i1), int(i2))
+
+    def window(self, t1=None, t2=None):
+        """
+
+        @param t1: start in ms, None for the first point
+        @param t2: end in ms (excluded), None for after the last point
+        @return: slice of the time points in [t1, t2)
+        """
+        start = 0 if t1 is None else int(np.searchsorted(self.times, t1))
+        stop = (len(self.times) if t2 is None
+                else int(np.searchsorted(self.times, t2)))
+        return slice(start, stop)
+
+
+def as_timeline(timeline):
+    """
+
+    @param timeline: Timeline, or sorted 1-d np array of times
+    @return: timeline itself if a Timeline, else a Timeline of its times
+    """
+    if isinstance(timeline, Timeline):
+        return timeline
+    return Timeline(timeline)
+
+
+def time_axis(data):
+    """
+
+    @param data: data object
+    @return: its Timeline (built if the data object has none)
+    """
+    if 'timeline' in data:
+        return data['timeline']
+    return Timeline(data['time'])
+
+
 def convert_subjects(ids, id_map):
     """
 Adjust subjects from ids to their id_map mapping,
@@ -187,56 +1169,256 @@ keep 'not mapped' ids as they are.
     @param id_map: mapping to other ids list
     @return: converted ids array
     """
-    def converter(sub_id):
-        if sub_id in id_map:
-            return id_map[sub_id]
-        else:
-            return sub_id
-    return np.vectorize(converter)(ids)
+    return SubjectIndex.translate(ids, id_map)
 
 
-def insert_behave_data(data_obj, behave_path, eprime_patterns, id_map):
-    eeg_subs = data_obj['subjects']
-    behave_ingestor = BehaveIngest(behave_path, eprime_patterns)
-    behave_subs = behave_ingestor.get_subjects()
+@profiling.profiled()
+def insert_behave_data(data_obj, behave_path, eprime_patterns, id_map,
+                       workers=None, encoding=None, manifest=None):
+    behave_ingestor = BehaveIngest(behave_path, eprime_patterns, encoding)
+    if manifest is None:
+        behave_subs, rts = behave_ingestor.ingest(workers=workers)
+    else:   # parse only new or changed files
+        behave_subs, rts = behave_ingestor.refresh(manifest, workers=workers)
     corrected_behave_subs = convert_subjects(behave_subs, id_map)
-    rts = behave_ingestor.get_rts()
-
-    # create data matrix of shape (len(eeg_subs), rts.shape[1])
-    data_rts = np.zeros((47,rts.shape[1]))
-    for i in range(len(eeg_subs)):
-        search = np.argwhere(corrected_behave_subs
-                             ==eeg_subs[i]).flatten()  # np array of
-        # corresponding index in behavioural data.
-        # If found, the index is (1,) np array, If not it's an empty array
-        if len(search)>0:   # behavioural data exists
-            behave_idx =search[0]
-            data_rts[i,:] = rts[behave_idx,:]
-        else:   # behavioural data doesn't exist
-            data_rts[i,:] = np.nan
-
-    # assign matrix to data object
-    data_obj['behave'] = data_rts
-
-
-with open("CONFIG.yaml", 'r') as f:
-    doc = yaml.full_load(f)     # load configuration file
-    if not all(doc.values()):
+
+    # data matrix of shape (len(eeg_subs), rts.shape[1]), subjects without
+    # behavioural data are NaN
+    data_obj['behave'] = subject_index(data_obj).align(
+        corrected_behave_subs, rts)
+
+
+CONFIG_FILENAME = "CONFIG.yaml"
+REQUIRED_FIELDS = ('data_attr_name', 'mat_filename', 'behave_path',
+                   'eprime_patterns', 'id_map')
+DEFAULT_CACHE_DIR = ".eegtools_cache"
+BEHAVE_MANIFEST = "behave_manifest.json"
+# bump whenever the layout of a cached data object changes
+CACHE_VERSION = 7
+
+
+def load_config(filename=CONFIG_FILENAME):
+    """
+
+    @param filename: path to yaml configuration file (see CONFIG_template)
+    @return: dict of configuration values
+    """
+    with open(filename, 'r') as f:
+        doc = yaml.full_load(f)     # load configuration file
+    if not all(doc.get(field) for field in REQUIRED_FIELDS):
         print("Please fill all the fields in configuration file")
         raise IOError
+    return doc
+
+
+class DataCache:
+    '''
+    On-disk cache of an ingested data object. An entry is keyed by the path,
+    size and modification time of every source file, so any change in the
+    sources invalidates it. Entries are stores (see write_store), so cached
+    arrays are memory-mapped and shared through the page cache by every
+    process that reads them.
+
+    ...
+
+    Attributes
+    ----------
+    cache_dir: str
+        folder where cache entries are stored
+    sources: list
+        paths of the files the data object was ingested from
+    tag: str
+        extra text the key depends on (e.g the data attribute name)
+    key: str
+        hash of the sources signature
+
+    Methods
+    -------
+    read
+        returns the cached data object, or None on a cache miss
+    write
+        stores a data object under the current key
+    '''
+
+    def __init__(self, cache_dir, sources, tag=''):
+        self.cache_dir = cache_dir
+        self.sources = sources
+        self.tag = tag
+        self.key = self.signature(sources, tag)
+
+    @staticmethod
+    def signature(sources, tag=''):
+        """
+
+        @param sources: paths of source files
+        @param tag: extra text the signature depends on
+        @return: hex digest of (path, size, mtime) of all the sources
+        """
+        h = hashlib.sha1(f'{CACHE_VERSION}|{tag}'.encode())
+        for path in sorted(sources):
+            st = os.stat(path)
+            h.update(f'{os.path.abspath(path)}|{st.st_size}|'
+                     f'{st.st_mtime_ns};'.encode())
+        return h.hexdigest()
+
+    @property
+    def path(self):
+        return os.path.join(self.cache_dir, self.key)
+
+    def read(self, mmap_mode='r'):
+        if not is_store(self.path):
+            return None
+        return read_store(self.path, mmap_mode=mmap_mode)
+
+    def write(self, data_obj, s2_dtype=None):
+        write_store(data_obj, self.path, s2_dtype)
+
+
+class DataContext:
+    '''
+    Lazy access point to the experiment's data object. Nothing is read until
+    the data is first accessed (or load is called). Warm starts open the
+    .mat data from DataCache, and parse only E-Prime files that are new or
+    changed since the last start (see BehaveManifest). The cached s2 can be
+    stored as float32 or int16 ('storage_dtype' configuration key, see
+    write_store), analysis reductions accumulate in float64 either way.
+
+    ...
+
+    Attributes
+    ----------
+    config_file: str
+        path to yaml configuration file
+    config: dict
+        the loaded configuration (None until loaded)
+    cube: SummaryCube
+        precomputed summary statistics of s2, if enabled by the
+        'summary_cube' configuration key (None otherwise)
+    key: str
+        DataCache signature of the loaded data object, changes when its
+        sources do (e.g to key results computed from it)
+
+    Methods
+    -------
+    load
+        ingests the data object, or reads it from cache
+    '''
+
+    def __init__(self, config_file=CONFIG_FILENAME):
+        self.config_file = config_file
+        self.config = None
+        self._data = None
+        self._cube = None
+        self._key = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.load()
+        return self._data
+
+    @property
+    def cube(self):
+        if self._data is None:
+            self.load()
+        return self._cube
+
+    @property
+    def key(self):
+        if self._data is None:
+            self.load()
+        return self._key
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def keys(self):
+        return self.data.keys()
+
+    @profiling.profiled()
+    def load(self, use_cache=True):
+        """
+
+        @param use_cache: whether to read from and write to the on-disk cache
+        @return: the data object
+        """
+        self.config = load_config(self.config_file)
+        doc = self.config
+        profiling.configure(doc.get('profile'))
+        cache_dir = doc.get('cache_dir') or DEFAULT_CACHE_DIR
+        s2_dtype = doc.get('storage_dtype')
+        tag = doc['data_attr_name']
+        if s2_dtype is not None:
+            tag = f'{tag}|{s2_dtype}'
+        cache = DataCache(cache_dir, [doc['mat_filename']], tag=tag)
+        data_obj = cache.read() if use_cache else None
+        if data_obj is None:
+            # ingest eeg data from MATLAB structure
+            data_obj = MatIngest(
+                filename=doc['mat_filename'],
+                data_name=doc['data_attr_name']).create_data_obj()
+            if use_cache:
+                cache.write(data_obj, s2_dtype)
+                # reopen memory-mapped, the ingested copy can be released
+                data_obj = cache.read()
+        manifest = None
+        if use_cache:
+            manifest = BehaveManifest(
+                os.path.join(cache_dir, BEHAVE_MANIFEST))
+        self.insert_behave(data_obj, manifest)
+        self._data = data_obj
+        self._key = cache.key
+        self._cube = None
+        if doc.get('summary_cube'):
+            self._cube = self.load_cube(cache if use_cache else None)
+        return data_obj
+
+    @profiling.profiled()
+    def load_cube(self, cache=None):
+        """
+
+        @param cache: DataCache whose entry holds the cube, None to skip disk
+        @return: SummaryCube of the loaded s2, built on a cache miss
+        """
+        cube = SummaryCube.load(cache.path) if cache is not None else None
+        if cube is None:
+            # streamed into the cache entry, it may not fit in RAM
+            cube = SummaryCube.build(self._data['s2'],
+                                     path=None if cache is None else cache.path)
+        return cube
+
+    def insert_behave(self, data_obj, manifest=None):
+        """
+Ingest behavioural data from E-Prime output folder into data_obj
+        @param data_obj: data object
+        @param manifest: BehaveManifest, None to parse the whole folder
+        """
+        doc = self.config
+        # Configured JSON of E-prime patterns for extraction
+        with open(doc['eprime_patterns'], 'r') as jf:
+            patterns = json.load(jf)
+        with open(doc['id_map'], 'r') as jf:
+            id_map = json.load(jf)
+        insert_behave_data(data_obj, doc['behave_path'], patterns, id_map,
+                           workers=doc.get('behave_workers'),
+                           encoding=doc.get('eprime_encoding'),
+                           manifest=manifest)
+
+    def clear(self):
+        """
+Drop the loaded data object, next access will load it again.
+        """
+        self._data = None
+        self._cube = None
+        self._key = None
+
 
-    MAT_FILENAME = doc['mat_filename']
-    DATA_ATTR_NAME = doc['data_attr_name']
-    BEHAVE_PATH = doc['behave_path']
-    ID_MAP = doc['id_map']
-    # Configured JSON of E-prime patterns for extraction
-    EPRIME_PATTERNS = doc['eprime_patterns']
-    with open(EPRIME_PATTERNS, 'r') as jf:
-        PATTERNS = json.load(jf)
-
-    # ingest eeg data from MATLAB structure
-    mat_data = MatIngest(filename=MAT_FILENAME,
-                         data_name=DATA_ATTR_NAME).create_data_obj()
-
-    # Ingest behavioural data from E-Prime output folder
-    insert_behave_data(mat_data, BEHAVE_PATH, PATTERNS, ID_MAP)
+# data object of the experiment, loaded on first access
+mat_data = DataContext()
@@ -0,0 +1,241 @@
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from analysis import subject_fits, group_reduce, trial_block_index
+from features import extract_features, METRICS
+
+# tensors opened by this (worker) process, by their description
+_TENSORS = {}
+
+
+def open_tensor(desc):
+    """
+Open a tensor described by SharedTensor.desc, once per process.
+    @param desc: ('npy', path) or ('shm', name, shape, dtype, order)
+    @return: np array viewing the shared data (no copy)
+    """
+    if desc not in _TENSORS:
+        if desc[0] == 'npy':
+            _TENSORS[desc] = (np.load(desc[1], mmap_mode='r'), None)
+        else:
+            _, name, shape, dtype, order = desc
+            shm = shared_memory.SharedMemory(name=name)
+            # keep shm referenced, the array is valid as long as it's open
+            _TENSORS[desc] = (np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                                         order=order), shm)
+    return _TENSORS[desc][0]
+
+
+class SharedTensor:
+    '''
+    The s2 tensor in a form worker processes open without receiving a copy:
+    the .npy file of a memory-mapped store is reopened as is, any other
+    array (or proxy) is copied once into a shared memory block, in the same
+    memory order (reductions' rounding depends on it).
+
+    ...
+
+    Attributes
+    ----------
+    desc: tuple
+        picklable description, see open_tensor
+    shape: tuple
+        shape of the tensor
+
+    Methods
+    -------
+    close
+        releases the shared memory block, if one was created
+    '''
+
+    def __init__(self, s2):
+        self.shape = tuple(s2.shape)
+        self.shm = None
+        filename = getattr(s2, 'filename', None)
+        if isinstance(s2, np.memmap) and filename and \
+                np.load(filename, mmap_mode='r').shape == self.shape:
+            self.desc = ('npy', filename)
+            return
+        dtype = np.dtype(s2.dtype)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=max(1, int(np.prod(self.shape)) * dtype.itemsize))
+        flags = getattr(s2, 'flags', None)   # proxies are read C ordered
+        order = 'C'
+        if flags is not None and flags.f_contiguous and not flags.c_contiguous:
+            order = 'F'
+        self.desc = ('shm', self.shm.name, self.shape, dtype.str, order)
+        out = np.ndarray(self.shape, dtype=dtype, buffer=self.shm.buf,
+                         order=order)
+        for start in range(0, self.shape[0], 8):
+            out[start:start + 8] = s2[start:start + 8]
+        del out
+
+    def close(self):
+        if self.shm is not None:
+            _TENSORS.pop(self.desc, None)
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def _subject_fits_task(desc, rows, trial, block, avg_over):
+    return subject_fits(open_tensor(desc), rows, trial, block, avg_over)
+
+
+def _features_task(desc, rows, blocks, specs, timeline, metrics):
+    s2 = open_tensor(desc)[rows.start:rows.stop, :, :, blocks]
+    return extract_features(s2, specs, timeline, metrics)
+
+
+def _bootstrap_task(sub_vals_arr, n_boot, seed_seq):
+    rng = np.random.default_rng(seed_seq)
+    n = len(sub_vals_arr)
+    samples = rng.integers(0, n, size=(n_boot, n))
+    return np.nanmean(sub_vals_arr[samples], axis=1)
+
+
+class ShardExecutor:
+    '''
+    Runs study-wide analyses on shards of the s2 tensor over a process pool.
+    Workers open the tensor through SharedTensor instead of receiving pickled
+    copies, and partial results are reduced in shard order, so a result
+    doesn't depend on the number of workers and matches the serial
+    (workers=1) path bit-for-bit.
+
+    Use as a context manager, or call close when done.
+
+    ...
+
+    Attributes
+    ----------
+    tensor: SharedTensor
+        the shared s2 tensor
+    workers: int
+        number of processes, 1 runs every shard in this process
+    shard_size: int
+        number of subjects per shard
+
+    Methods
+    -------
+    subject_fits
+        per-subject values and noise of a group, sharded by subject
+    group_average
+        GroupSignal.fit values and noise, sharded by subject
+    features
+        extract_features, sharded by subject (or subject x block)
+    bootstrap
+        bootstrap distribution of a group's mean signal
+    '''
+
+    def __init__(self, s2, workers=None, shard_size=4):
+        self.tensor = SharedTensor(s2)
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.pool = None
+        if self.workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.tensor.close()
+
+    def map(self, func, *iterables):
+        """
+
+        @return: list of func results, in the order of the iterables
+        """
+        if self.pool is None:
+            return list(map(func, *iterables))
+        return list(self.pool.map(func, *iterables))
+
+    def row_shards(self, rows):
+        return [rows[i:i + self.shard_size]
+                for i in range(0, len(rows), self.shard_size)]
+
+    def subject_fits(self, rows, trials, blocks):
+        """
+
+        @param rows: int np array of the group's rows (SubjectIndex.group)
+        @param trials: int or (start, end), see trial_block_index
+        @param blocks: int or (start, end), see trial_block_index
+        @return: (values, noise) per subject, see analysis.subject_fits
+        """
+        trial, block, avg_over = trial_block_index(trials, blocks)
+        shards = self.row_shards(np.asarray(rows))
+        n = len(shards)
+        parts = self.map(_subject_fits_task, [self.tensor.desc] * n, shards,
+                         [trial] * n, [block] * n, [avg_over] * n)
+        sub_vals_arr = np.concatenate([vals for vals, _ in parts])
+        sub_noise_arr = None
+        if avg_over != "none":
+            sub_noise_arr = np.concatenate([noise for _, noise in parts])
+        return sub_vals_arr, sub_noise_arr
+
+    def group_average(self, rows, trials, blocks):
+        """
+
+        @param rows: see subject_fits
+        @param trials: see subject_fits
+        @param blocks: see subject_fits
+        @return: (mean, noise) as GroupSignal.fit computes them
+        """
+        return group_reduce(*self.subject_fits(rows, trials, blocks))
+
+    def features(self, specs, timeline, metrics=METRICS, block_shards=1):
+        """
+
+        @param specs: list of ComponentSpec
+        @param timeline: timeline of s2's time axis
+        @param metrics: see extract_features
+        @param block_shards: number of shards of the block axis (shards are
+        subject x block)
+        @return: see extract_features
+        """
+        n_sub, n_blocks = self.tensor.shape[0], self.tensor.shape[3]
+        block_size = -(-n_blocks // block_shards)
+        shards = [(slice(r, min(r + self.shard_size, n_sub)),
+                   slice(b, min(b + block_size, n_blocks)))
+                  for r in range(0, n_sub, self.shard_size)
+                  for b in range(0, n_blocks, block_size)]
+        n = len(shards)
+        parts = self.map(_features_task, [self.tensor.desc] * n,
+                         [rows for rows, _ in shards],
+                         [blocks for _, blocks in shards],
+                         [specs] * n, [np.asarray(timeline)] * n,
+                         [metrics] * n)
+        out = np.empty((n_sub, self.tensor.shape[2], n_blocks, len(specs),
+                        len(metrics)))
+        for (rows, blocks), part in zip(shards, parts):
+            out[rows, :, blocks] = part
+        return out
+
+    def bootstrap(self, rows, trials, blocks, n_boot=1000, seed=None,
+                  batch_size=100):
+        """
+Bootstrap distribution of the group mean signal: subjects are resampled
+with replacement. Batches of resamples run in parallel, each with its own
+seed spawned from seed, so the result depends only on seed and batch_size.
+        @param rows: see group_average
+        @param trials: see group_average
+        @param blocks: see group_average
+        @param n_boot: number of resamples
+        @param seed: seed of the random generator
+        @param batch_size: number of resamples per task
+        @return: np array (n_boot, time) of resampled group means
+        """
+        sub_vals_arr = self.subject_fits(rows, trials, blocks)[0]
+        sizes = [min(batch_size, n_boot - i)
+                 for i in range(0, n_boot, batch_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        parts = self.map(_bootstrap_task, [sub_vals_arr] * len(sizes), sizes,
+                         seeds)
+        return np.concatenate(parts)
@@ -0,0 +1,106 @@
+import numpy as np
+from collections import namedtuple
+from data_ingestion import valid_epochs, as_timeline
+
+# a component window, e.g ComponentSpec('N100', 'N', 80, 120)
+ComponentSpec = namedtuple('ComponentSpec',
+                           ['name', 'orientation', 't1', 't2', 'baseline'],
+                           defaults=[0])
+METRICS = ('sum', 'abs_sum', 'rms', 'peak', 'auc')
+# np.trapz was renamed np.trapezoid in numpy 2.0 (and later removed)
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+
+def window_metrics(values, timeline, orientation, metrics=METRICS):
+    """
+Component metrics along the time axis (axis=1), with the same semantics as
+analysis.Component's methods.
+    @param values: np array (n, window time, ...) baseline corrected values
+    @param timeline: timeline of the window
+    @param orientation: 'N' or 'P'
+    @param metrics: names of metrics, see METRICS
+    @return: np array (n, ..., len(metrics))
+    """
+    out = []
+    for metric in metrics:
+        if metric == 'sum':
+            out.append(np.nansum(values, axis=1))
+        elif metric == 'abs_sum':
+            out.append(np.nansum(np.abs(values), axis=1))
+        elif metric == 'rms':
+            out.append(np.sqrt(np.nanmean(values, axis=1)))
+        elif metric == 'peak':
+            if orientation == "N":
+                out.append(np.nanmin(values, axis=1))
+            else:
+                out.append(np.max(values, axis=1))
+        elif metric == 'auc':
+            out.append(trapezoid(y=values, x=timeline, axis=1))
+        else:
+            raise ValueError(f"unknown metric: {metric}, "
+                             f"allowed are {METRICS}")
+    return np.stack(out, axis=-1)
+
+
+def extract_features(s2, specs, timeline, metrics=METRICS, chunk=8,
+                     valid=None):
+    """
+Component features of every subject, trial and block of the eeg tensor.
+Windows are resolved once, and every metric is a vectorized reduction
+along the time axis of the valid epochs of a chunk of subjects. All-NaN
+epochs are skipped, their features are NaN.
+    @param s2: eeg tensor (subjects, time, trials, blocks), array or proxy
+    @param specs: list of ComponentSpec
+    @param timeline: Timeline (or times) of s2's time axis
+    @param metrics: names of metrics, see METRICS
+    @param chunk: number of subjects processed at once
+    @param valid: bool np array (subjects, trials, blocks) of valid epochs
+    (see data_ingestion.EpochIndex), None to find them in s2
+    @return: np array of shape (subjects, trials, blocks, len(specs),
+    len(metrics))
+    """
+    timeline = as_timeline(timeline)
+    windows = [timeline.index([spec.t1, spec.t2]) for spec in specs]
+    n_sub, _, n_trials, n_blocks = s2.shape
+    out = np.full((n_sub, n_trials, n_blocks, len(specs), len(metrics)),
+                  np.nan)
+    for start in range(0, n_sub, chunk):
+        x = np.asarray(s2[start:start + chunk])
+        rows = slice(start, start + len(x))
+        mask = (valid_epochs(x, chunk=len(x)) if valid is None
+                else np.asarray(valid[rows]))
+        for c, (spec, (i1, i2)) in enumerate(zip(specs, windows)):
+            # window of the valid epochs, (1, window time, valid epochs),
+            # in float64 whatever the storage dtype of s2
+            epochs = np.moveaxis(x[:, i1:i2], 1, 0)[:, mask][None].astype(
+                np.float64, copy=False)
+            out[rows][mask, c] = window_metrics(
+                epochs - spec.baseline, timeline[i1:i2], spec.orientation,
+                metrics)[0]
+    return out
+
+
+def feature_table(features, specs, metrics=METRICS, subjects=None):
+    """
+Long format of extract_features output, one row per subject, trial, block
+and component (pandas.DataFrame(table) makes it a DataFrame).
+    @param features: output of extract_features
+    @param specs: its list of ComponentSpec
+    @param metrics: its metrics
+    @param subjects: subject names by row, None for row numbers
+    @return: dict column name -> 1-d np array
+    """
+    n_sub, n_trials, n_blocks, n_comp, _ = features.shape
+    sub, trial, block, comp = np.meshgrid(
+        np.arange(n_sub), np.arange(n_trials), np.arange(n_blocks),
+        np.arange(n_comp), indexing='ij')
+    table = {
+        'subject': (sub.ravel() if subjects is None
+                    else np.asarray(subjects)[sub.ravel()]),
+        # 1-based like the rest of the user facing trial/block numbers
+        'trial': trial.ravel() + 1,
+        'block': block.ravel() + 1,
+        'component': np.array([spec.name for spec in specs])[comp.ravel()]}
+    for m, metric in enumerate(metrics):
+        table[metric] = features[..., m].ravel()
+    return table
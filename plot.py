@@ -1,11 +1,18 @@
 import plotly.graph_objects as go
-# import analysis
+import numpy as np
+import uuid
+import profiling
 from itertools import cycle
 from matplotlib import colors
 
 MU_STR = '\u03BC'
 MICROVOLT_STR = MU_STR+"V"
 
+# level of detail: traces are decimated to LOD_POINTS points, and switch to
+# WebGL above GL_THRESHOLD points
+LOD_POINTS = 2000
+GL_THRESHOLD = 5000
+
 CMAP = {"Control":
             {"line":"royalblue", "error":"rgba(65,105,225,0.25)",   # to be deprecated
              'lighters':[(7, 16, 44),  # darkest
@@ -52,22 +59,30 @@ def read_rgb(rgb_tuple,error=False):
 
 
 
+@profiling.profiled()
 def add_baseline(fig, baseline=0, signal=None):
     """
 Add an horizontal baseline to a given plotly Figure.
     @param fig: go.Figure object.
     @param baseline: the value of the baseline
-            integer, or string indicates one method from {"Walter"}.
+            integer, or string indicates one method from
+            baseline.BASELINE_METHODS, case insensitive (e.g "Walter").
     @param signal: the signal for computing the baseline, mandatory if
-                    baseline argument == "Walter
+                    baseline argument is a method
     """
-    if baseline == "Walter":
+    if isinstance(baseline, str):
+        # imported here, analysis imports plot
+        import analysis
+        analysis.check_method(baseline)
+        # both methods level an averaged signal at its pre-stimulus mean
         baseline = analysis.walter_baseline(signal)
+    # across the whole plot area, whatever the x range (paper coordinates)
     fig.add_shape(
         type="line",
-        x0=-500,
+        xref="paper",
+        x0=0,
         y0=baseline,
-        x1=1500,
+        x1=1,
         y1=baseline,
         line=dict(
             color="black",
@@ -81,12 +96,14 @@ Add a vertical line to a given fig that will represent a stimuli in the trial
     @param fig: go.Figure object
     @param time: time of the stimuli (int)
     """
+    # across the whole plot area, whatever the y range (paper coordinates)
     fig.add_shape(
         type="line",
         x0=time,
-        y0=-13,
+        yref="paper",
+        y0=0,
         x1=time,
-        y1=13,
+        y1=1,
         line=dict(
             color="brown",
             width=1,
@@ -113,24 +130,43 @@ def add_component(fig,comp, stimulus_time):
     ))
 
 
+def range_label(pack):
+    """
+
+    @param pack: 1-based trial or block, int or (start, end)
+    @return: label of the range for legends, e.g '3' or '1-10'
+    """
+    if isinstance(pack, int):
+        return f'{pack}'
+    return f'{pack[0]}-{pack[1]}'
+
+
+@profiling.profiled()
 def init_trial(stimuli_times=[0], baseline=0, signal=None,
-               components=None, **kwargs):
+               components=None, widget=False, timeline=None, **kwargs):
     """
 Initialization of a figure representing a trial
     @param components: lst of tuples [(0,N100), (0,P200)]
     @param stimuli_times: list or tuple for adding vertical lines which will
                             represent the stimuli's time in the trial.
-    @param baseline: integer or a method {"Walter"} for horizontal baseline
-    @param signal: mandatory if baseline is "Walter"
-    @return: go.Figure object
+    @param baseline: integer or a method (e.g "Walter") for horizontal
+                    baseline, see add_baseline
+    @param signal: mandatory if baseline is a method
+    @param widget: create a go.FigureWidget, which sends only the changes to
+                    the frontend when traces are added
+    @param timeline: Timeline of the trial, sets the x axis range to its
+                    extent (autorange if None)
+    @return: go.Figure (or go.FigureWidget) object
     """
-    fig = go.Figure()
+    fig = go.FigureWidget() if widget else go.Figure()
     # can be changed by the user later, out of the function, or by sending kwargs
     fig.update_layout(template="plotly_white",
                       xaxis_title="time (ms)",
                       yaxis_title=f"signal ({MICROVOLT_STR})",
                       **kwargs)
 
+    if timeline is not None:
+        fig.update_xaxes(range=timeline.extent)
     add_baseline(fig, baseline, signal)
     for t in stimuli_times:
         add_stimulus(fig, t)
@@ -142,11 +178,179 @@ Initialization of a figure representing a trial
     return fig
 
 
-def go_signal(signal, timeline, group=None, noise=None,**kwargs):
+@profiling.profiled()
+def go_signal(signal, timeline, group=None, noise=None, n_full=None,
+              **kwargs):
+    # WebGL renders long traces much faster than SVG, decided on the full
+    # resolution length (n_full) of a decimated signal
+    n_points = len(signal) if n_full is None else n_full
+    scatter = go.Scattergl if n_points > GL_THRESHOLD else go.Scatter
+    timeline = np.asarray(timeline)     # a Timeline's times
     if group is None:
-        return go.Scatter(x=timeline, y=signal, **kwargs)
-    return go.Scatter(x=timeline, y=signal,
-                      line_color=CMAP[group]['line'], **kwargs)
+        return scatter(x=timeline, y=signal, **kwargs)
+    return scatter(x=timeline, y=signal,
+                   line_color=CMAP[group]['line'], **kwargs)
+
+
+def minmax_indices(y, n_points):
+    """
+Peak preserving decimation: the min and the max of each of n_points / 2
+equal buckets (and the first and last points).
+    @param y: 1-d np array
+    @param n_points: target number of points
+    @return: sorted int np array of kept indices
+    """
+    n = len(y)
+    if n <= n_points:
+        return np.arange(n)
+    n_buckets = max(1, (n_points - 2) // 2)
+    edges = np.linspace(0, n, n_buckets + 1).astype(int)
+    # NaN never wins a min/max, an all NaN bucket keeps its first point
+    low = np.where(np.isnan(y), np.inf, y)
+    high = np.where(np.isnan(y), -np.inf, y)
+    mins = [s + np.argmin(low[s:e]) for s, e in zip(edges[:-1], edges[1:])]
+    maxs = [s + np.argmax(high[s:e]) for s, e in zip(edges[:-1], edges[1:])]
+    return np.unique(np.concatenate([[0, n - 1], mins, maxs]))
+
+
+def lttb_indices(x, y, n_points):
+    """
+Largest-Triangle-Three-Buckets decimation (Steinarsson, 2013): keeps the
+point of each bucket that forms the largest triangle with its neighbours.
+    @param x: 1-d np array
+    @param y: 1-d np array
+    @param n_points: target number of points
+    @return: sorted int np array of kept indices
+    """
+    n = len(y)
+    if n <= n_points or n_points < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    edges = np.linspace(1, n - 1, n_points - 1).astype(int)
+    out = [0]
+    for b in range(n_points - 2):
+        start, end = edges[b], edges[b + 1]
+        # average of the next bucket (the last point for the last bucket)
+        nxt = slice(end, edges[b + 2]) if b + 2 < len(edges) else \
+            slice(n - 1, n)
+        x_avg, y_avg = x[nxt].mean(), y[nxt].mean()
+        a = out[-1]
+        area = np.abs((x[a] - x_avg) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (y_avg - y[a]))
+        out.append(start + int(np.argmax(area)))
+    out.append(n - 1)
+    return np.array(out)
+
+
+@profiling.profiled()
+def decimate(timeline, values, noise=None, n_points=LOD_POINTS,
+             method="minmax"):
+    """
+
+    @param timeline: x of a signal
+    @param values: y of a signal
+    @param noise: error of a signal, or None
+    @param n_points: target number of points, None keeps all
+    @param method: one of {"minmax", "lttb"}
+    @return: (timeline, values, noise) decimated together
+    """
+    if n_points is None or len(values) <= n_points:
+        return timeline, values, noise
+    if method == "minmax":
+        idx = minmax_indices(values, n_points)
+    elif method == "lttb":
+        idx = lttb_indices(timeline, values, n_points)
+    else:
+        raise ValueError(f"incorrect method: {method}, "
+                         "allowed are {'minmax', 'lttb'}")
+    timeline, values = np.asarray(timeline)[idx], np.asarray(values)[idx]
+    if noise is not None:
+        noise = np.asarray(noise)[idx]
+    return timeline, values, noise
+
+
+@profiling.profiled()
+def add_lod_trace(fig, gos, timeline, values, noise=None):
+    """
+Add a (decimated) trace to fig, keeping its full resolution data so
+enable_zoom_lod can re-fetch it when zooming in.
+    @param fig: go.FigureWidget (or go.Figure)
+    @param gos: the trace
+    @param timeline, values, noise: full resolution signal of the trace
+    @return: uid of the added trace
+    """
+    if gos.uid is None:
+        gos.update(uid=uuid.uuid4().hex)
+    fig.add_trace(gos)
+    if not hasattr(fig, '_lod_data'):
+        fig._lod_data = {}
+    # a FigureWidget may assign its own uid
+    uid = fig.data[-1].uid
+    fig._lod_data[uid] = (np.asarray(timeline), np.asarray(values), noise)
+    return uid
+
+
+@profiling.profiled()
+def update_lod_trace(fig, uid, timeline, values, noise=None, **kwargs):
+    """
+Replace the signal of a trace added by add_lod_trace, e.g by a fit refined
+as its parts complete.
+    @param fig: go.FigureWidget (or go.Figure)
+    @param uid: uid of the trace, see add_lod_trace
+    @param timeline, values, noise: new full resolution signal of the trace
+    @param kwargs: other trace properties to update, e.g name
+    """
+    fig._lod_data[uid] = (np.asarray(timeline), np.asarray(values), noise)
+    x, y, err = decimate(np.asarray(timeline), values, noise)
+    with fig.batch_update():
+        for trace in fig.select_traces(selector={'uid': uid}):
+            trace.update(x=x, y=y, **kwargs)
+            if err is not None:
+                trace.update(error_y_array=err / 2)
+
+
+def remove_lod_trace(fig, uid):
+    """
+
+    @param fig: go.FigureWidget (or go.Figure)
+    @param uid: uid of a trace added by add_lod_trace
+    """
+    fig.data = [trace for trace in fig.data if trace.uid != uid]
+    getattr(fig, '_lod_data', {}).pop(uid, None)
+
+
+def enable_zoom_lod(fig, n_points=LOD_POINTS, method="minmax"):
+    """
+Re-decimate the traces added by add_lod_trace to the visible x range, each
+time it changes. Zooming in the browser reaches Python only on a
+go.FigureWidget.
+    @param fig: go.FigureWidget
+    @param n_points: target number of points in the visible range
+    @param method: see decimate
+    """
+    @profiling.profiled('enable_zoom_lod.on_range')
+    def on_range(xaxis, x_range):
+        lod_data = getattr(fig, '_lod_data', {})
+        with fig.batch_update():
+            for trace in fig.data:
+                if trace.uid not in lod_data:
+                    continue
+                timeline, values, noise = lod_data[trace.uid]
+                if x_range is None:   # autorange, the whole signal
+                    visible = slice(None)
+                else:
+                    visible = (timeline >= x_range[0]) & \
+                              (timeline <= x_range[1])
+                x, y, err = decimate(
+                    timeline[visible], values[visible],
+                    None if noise is None else np.asarray(noise)[visible],
+                    n_points, method)
+                trace.update(x=x, y=y)
+                if err is not None:
+                    trace.update(error_y_array=err / 2)
+
+    fig.layout.xaxis.on_change(on_range, 'range', append=True)
 
 # TODO: move all this file's functions to a Python Class
 #  in order to let the user insert a default timeline
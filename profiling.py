@@ -0,0 +1,308 @@
+"""
+Lightweight instrumentation of eegtools hot paths: timers, call counts and
+peak bytes allocated, recorded per call stack of instrumented functions.
+
+Off by default, an instrumented call then costs a single flag check. Enable
+it with the EEGTOOLS_PROFILE environment variable ("1", or "memory" to also
+trace allocations), the 'profile' configuration key, or from a notebook:
+
+    import profiling
+    profiling.enable()
+    ...                      # click around the dashboard
+    print(profiling.report())
+    profiling.dump_collapsed('eegtools.folded')   # for flamegraph.pl
+
+Calls in worker processes (e.g BehaveIngest with workers > 1) are not
+recorded.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+ENV_VAR = 'EEGTOOLS_PROFILE'
+
+
+def traced_peak():
+    """
+
+    @return: (current, peak) bytes traced by tracemalloc, the peak since the
+    last reset_peak; before Python 3.9 (no reset_peak) the current bytes
+    stand for the peak, sampled when timers enter and exit
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    if not hasattr(tracemalloc, 'reset_peak'):
+        return current, current
+    return current, peak
+
+
+class Timer:
+    '''
+    Context manager timing one instrumented call, see Profiler.timer.
+    '''
+    __slots__ = ('profiler', 'name', 'path', 'start', 'child', 'bytes0',
+                 'peak')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        parent = stack[-1] if stack else None
+        self.path = (parent.path if parent else ()) + (self.name,)
+        self.child = 0.0
+        self.bytes0, self.peak = 0, 0
+        if self.profiler.memory:
+            current, peak = traced_peak()
+            if parent is not None:
+                parent.peak = max(parent.peak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.bytes0, self.peak = current, current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = self.profiler.stack()
+        stack.pop()
+        nbytes = 0
+        if self.profiler.memory:
+            self.peak = max(self.peak, traced_peak()[1])
+            nbytes = self.peak - self.bytes0
+        if stack:
+            stack[-1].child += elapsed
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        self.profiler.record(self.path, elapsed, elapsed - self.child, nbytes)
+
+
+class NullTimer:
+    '''
+    Timer of a disabled Profiler, does nothing.
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Profiler:
+    '''
+    Collects timings of instrumented calls (see profiled and timer), by call
+    stack of instrumented names.
+
+    ...
+
+    Attributes
+    ----------
+    enabled: bool
+        whether calls are recorded
+    memory: bool
+        whether peak bytes allocated are traced (with tracemalloc, which
+        slows everything down)
+    records: dict
+        stack (tuple of names) -> [calls, seconds, self seconds, peak bytes]
+
+    Methods
+    -------
+    timer
+        context manager recording a block of code under a name
+    summary
+        totals by name
+    report
+        text table of summary, for printing in a notebook
+    to_json
+        summary and per stack records, as a JSON-compatible dict
+    to_collapsed
+        self times in the collapsed stack format of flame graph tools
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.records = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tracing = False
+
+    def enable(self, memory=False):
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+    def disable(self):
+        self.enabled = False
+        self.memory = False
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def reset(self):
+        with self._lock:
+            self.records = {}
+
+    def stack(self):
+        """
+
+        @return: this thread's list of open Timers
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def timer(self, name):
+        """
+
+        @param name: name of the timed block, e.g 'subject_fits.gather'
+        @return: context manager recording the block while enabled
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def record(self, path, seconds, self_seconds, nbytes):
+        with self._lock:
+            rec = self.records.get(path)
+            if rec is None:
+                rec = self.records[path] = [0, 0.0, 0.0, 0]
+            rec[0] += 1
+            rec[1] += seconds
+            rec[2] += self_seconds
+            rec[3] = max(rec[3], nbytes)
+
+    def summary(self):
+        """
+
+        @return: dict name -> {'calls', 'seconds', 'self_seconds',
+        'peak_bytes'}, over all the stacks the name was called in
+        """
+        out = {}
+        with self._lock:
+            records = list(self.records.items())
+        for path, (calls, seconds, self_seconds, nbytes) in records:
+            row = out.setdefault(path[-1], {'calls': 0, 'seconds': 0.0,
+                                            'self_seconds': 0.0,
+                                            'peak_bytes': 0})
+            row['calls'] += calls
+            # a name nested in itself would be counted twice
+            if path[-1] not in path[:-1]:
+                row['seconds'] += seconds
+            row['self_seconds'] += self_seconds
+            row['peak_bytes'] = max(row['peak_bytes'], nbytes)
+        return out
+
+    def report(self, sort='seconds'):
+        """
+
+        @param sort: column of summary to sort by, descending
+        @return: str table of summary
+        """
+        rows = sorted(self.summary().items(), key=lambda kv: -kv[1][sort])
+        width = max([len(name) for name, _ in rows] + [4])
+        lines = [f"{'name':<{width}} {'calls':>8} {'total ms':>10} "
+                 f"{'self ms':>10} {'peak MB':>9}"]
+        for name, row in rows:
+            lines.append(f"{name:<{width}} {row['calls']:>8} "
+                         f"{row['seconds'] * 1e3:>10.2f} "
+                         f"{row['self_seconds'] * 1e3:>10.2f} "
+                         f"{row['peak_bytes'] / 2 ** 20:>9.2f}")
+        return '\n'.join(lines)
+
+    def to_json(self):
+        with self._lock:
+            records = list(self.records.items())
+        return {'summary': self.summary(),
+                'stacks': [{'stack': list(path), 'calls': calls,
+                            'seconds': seconds, 'self_seconds': self_seconds,
+                            'peak_bytes': nbytes}
+                           for path, (calls, seconds, self_seconds, nbytes)
+                           in records]}
+
+    def to_collapsed(self):
+        """
+
+        @return: str of 'name;name;name <self microseconds>' lines, as read
+        by flamegraph.pl, speedscope and similar tools
+        """
+        with self._lock:
+            records = list(self.records.items())
+        return '\n'.join(f"{';'.join(path)} {round(rec[2] * 1e6)}"
+                         for path, rec in records)
+
+
+# the profiler of this process
+PROFILER = Profiler()
+
+
+def profiled(name=None):
+    """
+Decorator recording calls of a function on PROFILER.
+    @param name: recorded name, defaults to the function's qualified name
+    """
+    def decorate(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            with Timer(PROFILER, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def timer(name):
+    return PROFILER.timer(name)
+
+
+def enable(memory=False):
+    PROFILER.enable(memory)
+
+
+def disable():
+    PROFILER.disable()
+
+
+def reset():
+    PROFILER.reset()
+
+
+def report(sort='seconds'):
+    return PROFILER.report(sort)
+
+
+def dump_json(filename):
+    with open(filename, 'w') as jf:
+        json.dump(PROFILER.to_json(), jf, indent=2)
+
+
+def dump_collapsed(filename):
+    with open(filename, 'w') as f:
+        f.write(PROFILER.to_collapsed() + '\n')
+
+
+def configure(setting):
+    """
+Enable from a configuration value, e.g of EEGTOOLS_PROFILE.
+    @param setting: falsy (or "0") to leave as is, "memory" to also trace
+    allocations, anything else to enable
+    """
+    if setting and str(setting).lower() not in ('0', 'false', 'no', 'off'):
+        enable(memory=str(setting).lower() == 'memory')
+
+
+configure(os.environ.get(ENV_VAR))
@@ -0,0 +1,357 @@
+"""
+Headless batch reports: fits a list of queries (subjects or groups x
+trial/block ranges x components) with one shared pass over the data, and
+renders static figure bundles in parallel, without a notebook.
+
+    python report.py <queries.yaml> <out folder> [--config CONFIG.yaml]
+                     [--formats html,json,png] [--workers 4]
+
+A queries file looks like:
+
+    components:
+      - {name: N100, t1: 80, t2: 120}
+      - {name: P200, t1: 150, t2: 250}
+    queries:
+      - {subjects: all, trials: [1, 10], blocks: [1, 34]}
+      - {groups: [ASD, Control], trials: 1, blocks: [1, 34],
+         components: [N100]}
+
+Trials and blocks are 1-based, an int or an inclusive [start, end] range.
+A component's orientation is the first letter of its name unless given.
+The out folder gets one bundle per page of PAGE_SIZE signals of a query
+(an HTML page, a JSON list of figures, a PNG grid) and report.json with
+every signal's valid epochs count and component metrics.
+"""
+import argparse
+import json
+import numpy as np
+import os
+import time
+import yaml
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import plot
+from analysis import Signal, subject_fits, group_reduce, trial_block_index
+from data_ingestion import DataContext, CONFIG_FILENAME, subject_index, \
+    epoch_index, as_timeline, time_axis
+from features import ComponentSpec, METRICS, window_metrics
+
+FORMATS = ('html', 'json', 'png')
+# signals per bundle, bundles are rendered in parallel
+PAGE_SIZE = 16
+PLOTLY_JS = 'plotly.min.js'
+
+# a normalized query, names are subjects or groups (see kind)
+Query = namedtuple('Query', ['kind', 'names', 'trials', 'blocks',
+                             'components'])
+
+
+def to_range(value):
+    """
+
+    @param value: int or [start, end] of a queries file
+    @return: int or (start, end), as analysis takes trials/blocks
+    """
+    if isinstance(value, (list, tuple)):
+        return int(value[0]), int(value[1])
+    return int(value)
+
+
+def load_queries(filename, data):
+    """
+
+    @param filename: yaml (or JSON) queries file, see the module docstring
+    @param data: data object, resolves 'all' subjects or groups
+    @return: (list of Query, list of ComponentSpec)
+    """
+    with open(filename, 'r') as f:
+        doc = yaml.safe_load(f)
+    specs = [ComponentSpec(c['name'], c.get('orientation', c['name'][0]),
+                           c['t1'], c['t2'], c.get('baseline', 0))
+             for c in doc.get('components', [])]
+    queries = []
+    for q in doc['queries']:
+        kind = 'subject' if 'subjects' in q else 'group'
+        names = q['subjects'] if kind == 'subject' else q['groups']
+        known = (list(data['subjects']) if kind == 'subject'
+                 else list(np.unique(data['group'])))
+        if names == 'all':
+            names = known
+        unknown = set(names) - set(known)
+        if unknown:
+            raise ValueError(f"unknown {kind}s in {filename}: "
+                             f"{sorted(unknown)}")
+        components = q.get('components', [spec.name for spec in specs])
+        queries.append(Query(kind, list(names), to_range(q['trials']),
+                             to_range(q['blocks']), list(components)))
+    return queries, specs
+
+
+def fit_queries(queries, data):
+    """
+Fit every signal of the queries. Per distinct trial-block range, all the
+subjects the queries need are fitted with one subject_fits gather, and
+groups are reduced from their subjects' fits (as GroupSignal.fit).
+    @param queries: list of Query
+    @param data: data object
+    @return: list (by query) of lists of dicts with the signal's label,
+    kind, name, group, values, noise and n_epochs (valid epochs)
+    """
+    index, epochs = subject_index(data), epoch_index(data)
+
+    def query_rows(q):
+        if q.kind == 'subject':
+            return index.rows(q.names)
+        return np.concatenate([index.group(g) for g in q.names])
+
+    ranges = {}
+    for q in queries:
+        ranges.setdefault((q.trials, q.blocks), set()).update(
+            query_rows(q).tolist())
+    fits = {}
+    for (trials, blocks), rows in ranges.items():
+        rows = np.array(sorted(rows), dtype=np.intp)
+        trial, block, avg_over = trial_block_index(trials, blocks)
+        vals, noise = subject_fits(data['s2'], rows, trial, block, avg_over,
+                                   valid=epochs.mask(rows, trial, block))
+        position = {row: i for i, row in enumerate(rows)}
+        fits[trials, blocks] = (position, vals, noise,
+                                epochs.count(rows, trial, block))
+
+    out = []
+    for q in queries:
+        position, vals, noise, counts = fits[q.trials, q.blocks]
+        signals = []
+        for name in q.names:
+            if q.kind == 'subject':
+                pos = [position[index.row(name)]]
+                group = data['group'][index.row(name)]
+                values = vals[pos[0]]
+                sig_noise = None if noise is None else noise[pos[0]]
+            else:
+                pos = [position[row] for row in index.group(name)]
+                group = name
+                values, sig_noise = group_reduce(
+                    vals[pos], None if noise is None else noise[pos])
+            signals.append({
+                'label': f'{name}|{plot.range_label(q.trials)}|'
+                         f'{plot.range_label(q.blocks)}',
+                'kind': q.kind, 'name': name, 'group': group,
+                'values': values, 'noise': sig_noise,
+                'n_epochs': int(np.sum(counts[pos]))})
+        out.append(signals)
+    return out
+
+
+def component_metrics(signals, specs, timeline, metrics=METRICS):
+    """
+
+    @param signals: fitted signals of a query, see fit_queries
+    @param specs: list of ComponentSpec of the query
+    @param timeline: Timeline (or times) of the signals
+    @param metrics: names of metrics, see features.METRICS
+    @return: list (by signal) of dicts component -> metric -> value, with
+    analysis.Component's semantics; None for a NaN or infinite value (e.g of
+    an all-NaN window), null in report.json
+    """
+    timeline = as_timeline(timeline)
+    values = np.stack([s['values'] for s in signals])
+    out = [{} for _ in signals]
+    for spec in specs:
+        i1, i2 = timeline.index([spec.t1, spec.t2])
+        with np.errstate(invalid='ignore'):
+            table = window_metrics(values[:, i1:i2] - spec.baseline,
+                                   timeline[i1:i2], spec.orientation,
+                                   metrics)
+        for row, metric_values in zip(out, table):
+            row[spec.name] = {m: float(v) if np.isfinite(v) else None
+                              for m, v in zip(metrics, metric_values)}
+    return out
+
+
+def component_labels(specs):
+    """
+
+    @return: (stimulus time, name) of components named like N100, as
+    plot.init_trial annotates them
+    """
+    labels = []
+    for spec in specs:
+        try:
+            float(spec.name[1:])
+        except ValueError:
+            continue
+        if spec.name[0] in ('N', 'P'):
+            labels.append((0, spec.name))
+    return labels
+
+
+def render_page(stem, formats, timeline, signals, specs):
+    """
+Render one bundle, module level so it can be sent to worker processes.
+    @param stem: output path without extension
+    @param formats: subset of FORMATS
+    @param timeline: timeline of the signals
+    @param signals: fitted signals, see fit_queries
+    @param specs: list of ComponentSpec annotated on the figures
+    @return: list of written files
+    """
+    written = []
+    if 'html' in formats or 'json' in formats:
+        import plotly.io as pio
+        figs = []
+        for s in signals:
+            fig = plot.init_trial(components=component_labels(specs),
+                                  title=s['label'])
+            group = s['group'] if s['group'] in plot.CMAP else None
+            fig.add_trace(Signal(s['values'], timeline, s['noise'],
+                                 group=group).get_gos(name=s['label']))
+            figs.append(fig)
+        if 'html' in formats:
+            divs = [pio.to_html(fig, full_html=False,
+                                include_plotlyjs=False) for fig in figs]
+            with open(f'{stem}.html', 'w', encoding='utf-8') as f:
+                f.write('<html><head><meta charset="utf-8">'
+                        f'<script src="{PLOTLY_JS}"></script></head>'
+                        f'<body>{"".join(divs)}</body></html>')
+            written.append(f'{stem}.html')
+        if 'json' in formats:
+            with open(f'{stem}.json', 'w', encoding='utf-8') as f:
+                f.write('[' + ','.join(pio.to_json(fig) for fig in figs) +
+                        ']')
+            written.append(f'{stem}.json')
+    if 'png' in formats:
+        png_grid(f'{stem}.png', timeline, signals, specs)
+        written.append(f'{stem}.png')
+    return written
+
+
+def png_grid(filename, timeline, signals, specs, cols=4):
+    """
+Static grid of the signals, drawn with matplotlib's Agg canvas (no
+display, no global backend switch).
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    cols = min(cols, len(signals))
+    rows = -(-len(signals) // cols)
+    fig = Figure(figsize=(4 * cols, 3 * rows))
+    FigureCanvasAgg(fig)
+    timeline = np.asarray(timeline)
+    for i, s in enumerate(signals):
+        ax = fig.add_subplot(rows, cols, i + 1)
+        color = plot.CMAP.get(s['group'], {}).get('line', 'black')
+        ax.plot(timeline, s['values'], color=color, linewidth=1)
+        if s['noise'] is not None:
+            # same band as the dashboards' error bars
+            ax.fill_between(timeline, s['values'] - s['noise'] / 2,
+                            s['values'] + s['noise'] / 2, color=color,
+                            alpha=0.25, linewidth=0)
+        for spec in specs:
+            ax.axvspan(spec.t1, spec.t2, color='grey', alpha=0.15)
+        ax.axvline(0, color='brown', linewidth=1, linestyle='--')
+        ax.axhline(0, color='black', linewidth=1, linestyle='--')
+        ax.set_title(f"{s['label']} (n={s['n_epochs']})", fontsize=9)
+        ax.set_xlabel('time (ms)', fontsize=8)
+        ax.set_ylabel(f'signal ({plot.MICROVOLT_STR})', fontsize=8)
+    fig.tight_layout()
+    fig.savefig(filename, dpi=100)
+
+
+def run_report(queries_file, out_dir, config_file=CONFIG_FILENAME,
+               formats=FORMATS, workers=None, page_size=PAGE_SIZE):
+    """
+
+    @param queries_file: yaml queries file, see the module docstring
+    @param out_dir: destination folder
+    @param config_file: configuration of the data, see DataContext
+    @param formats: subset of FORMATS
+    @param workers: rendering processes, None for one per CPU, 1 renders
+    in this process
+    @param page_size: signals per bundle
+    @return: the report dict, also written to out_dir/report.json
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"unknown formats: {sorted(unknown)}, "
+                         f"allowed are {FORMATS}")
+    seconds = {}
+    start = time.perf_counter()
+    data = DataContext(config_file)
+    data.load()
+    axis = time_axis(data)
+    timeline = axis.times
+    queries, specs = load_queries(queries_file, data)
+    seconds['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fitted = fit_queries(queries, data)
+    seconds['fit'] = time.perf_counter() - start
+
+    os.makedirs(out_dir, exist_ok=True)
+    if 'html' in formats:
+        from plotly.offline import get_plotlyjs
+        with open(os.path.join(out_dir, PLOTLY_JS), 'w',
+                  encoding='utf-8') as f:
+            f.write(get_plotlyjs())
+    tasks, entries = [], []
+    for i, (q, signals) in enumerate(zip(queries, fitted)):
+        q_specs = [spec for spec in specs if spec.name in q.components]
+        metrics = component_metrics(signals, q_specs, axis)
+        for p in range(0, len(signals), page_size):
+            stem = os.path.join(out_dir,
+                                f'query{i:03d}_page{p // page_size:03d}')
+            page = signals[p:p + page_size]
+            tasks.append((stem, tuple(formats), timeline, page, q_specs))
+            for s, m in zip(page, metrics[p:p + page_size]):
+                entries.append({'query': i, 'label': s['label'],
+                                'kind': s['kind'], 'name': str(s['name']),
+                                'group': str(s['group']),
+                                'trials': q.trials, 'blocks': q.blocks,
+                                'n_epochs': s['n_epochs'],
+                                'bundle': os.path.basename(stem),
+                                'components': m})
+
+    start = time.perf_counter()
+    if workers == 1 or len(tasks) < 2:
+        written = [render_page(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(
+                max_workers=min(workers or os.cpu_count() or 1,
+                                len(tasks))) as pool:
+            written = list(pool.map(render_page, *zip(*tasks)))
+    seconds['render'] = time.perf_counter() - start
+
+    report = {'queries_file': queries_file, 'config': config_file,
+              'formats': list(formats), 'signals': entries,
+              'files': [os.path.basename(fn) for fns in written
+                        for fn in fns],
+              'seconds': seconds}
+    with open(os.path.join(out_dir, 'report.json'), 'w') as jf:
+        # strict JSON, metrics are cleaned of NaN (see component_metrics)
+        json.dump(report, jf, indent=2, allow_nan=False)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries')
+    parser.add_argument('out_dir')
+    parser.add_argument('--config', default=CONFIG_FILENAME)
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help=f'comma separated of {", ".join(FORMATS)}')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    args = parser.parse_args()
+    report = run_report(args.queries, args.out_dir, args.config,
+                        args.formats.split(','), args.workers,
+                        args.page_size)
+    print(json.dumps({'signals': len(report['signals']),
+                      'files': len(report['files']),
+                      'seconds': report['seconds']}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Permutation tests of group differences on per-subject signals, with
+optional cluster-mass correction over the time axis.
+
+Permutations are drawn in batches as label matrices (one row of group
+indicators per permutation), so a batch's group sums are two matmuls with
+the subjects' signals instead of a Python loop per permutation. Batches are
+seeded from a SeedSequence spawned from seed, so a result depends only on
+seed and batch_size, also when batches run over ShardExecutor's processes.
+
+    from executor import ShardExecutor
+    with ShardExecutor(data['s2']) as ex:
+        res = group_comparison('Control', 'ASD', (1, 10), (1, 34),
+                               threshold=2.0, executor=ex)
+"""
+import numpy as np
+import profiling
+from collections import namedtuple
+from analysis import subject_fits, trial_block_index
+from data_ingestion import mat_data, subject_index, epoch_index
+
+STATISTICS = ('t', 'diff')
+
+# a supra-threshold run of time points [start, stop) of the observed
+# statistic, mass is its sum
+Cluster = namedtuple('Cluster', ['start', 'stop', 'mass', 'p'])
+
+# stat: (time,) observed statistic, p: (time,) uncorrected p-values,
+# p_max: (time,) p-values corrected by the max statistic, clusters: list of
+# Cluster, null_mass: (n_perm,) max cluster mass per permutation (None
+# without threshold), n: (n_a, n_b) subjects compared
+PermutationResult = namedtuple('PermutationResult',
+                               ['stat', 'p', 'p_max', 'clusters', 'null_mass',
+                                'n_perm', 'n'])
+
+
+def group_stat(sums, squares, totals, n_a, n_b, stat='t'):
+    """
+Statistic of group a vs b from group a's sums (b's are the totals minus
+a's), for a batch of labelings at once.
+    @param sums: (batch, time) sums of group a
+    @param squares: (batch, time) sums of squares of group a
+    @param totals: (sum, sum of squares), each (time,), over all subjects
+    @param n_a: number of subjects of group a
+    @param n_b: number of subjects of group b
+    @param stat: 't' for Welch's t, 'diff' for the difference of means
+    @return: (batch, time) np array
+    """
+    mean_a = sums / n_a
+    mean_b = (totals[0] - sums) / n_b
+    if stat == 'diff':
+        return mean_a - mean_b
+    var_a = (squares - n_a * mean_a ** 2) / (n_a - 1)
+    var_b = (totals[1] - squares - n_b * mean_b ** 2) / (n_b - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (mean_a - mean_b) / np.sqrt(np.maximum(var_a / n_a +
+                                                      var_b / n_b, 0))
+
+
+def tail_stat(stat, tail):
+    """
+
+    @return: the statistic oriented so that larger is more extreme
+    """
+    return np.abs(stat) if tail == 0 else stat * tail
+
+
+def max_cluster_mass(stat, threshold, tail=0):
+    """
+Largest cluster mass of each row: runs of consecutive time points beyond
+threshold, summed, computed for the whole batch with running sums.
+    @param stat: (batch, time) np array
+    @param threshold: positive cluster forming threshold
+    @param tail: 0 for clusters of both signs, 1 positive, -1 negative
+    @return: (batch,) np array of the largest absolute cluster mass
+    """
+    out = np.zeros(len(stat))
+    for sign in ((1, -1) if tail == 0 else (tail,)):
+        s = stat * sign
+        above = s > threshold
+        # non-decreasing, the mass of a run is its rise since the last gap
+        csum = np.cumsum(np.where(above, s, 0), axis=1)
+        at_gap = np.maximum.accumulate(np.where(above, 0, csum), axis=1)
+        out = np.maximum(out, np.max(csum - at_gap, axis=1, initial=0))
+    return out
+
+
+def find_clusters(stat, threshold, tail=0):
+    """
+
+    @param stat: (time,) np array
+    @param threshold: see max_cluster_mass
+    @param tail: see max_cluster_mass
+    @return: list of (start, stop, mass), mass signed as the statistic
+    """
+    clusters = []
+    for sign in ((1, -1) if tail == 0 else (tail,)):
+        above = np.concatenate([[False], stat * sign > threshold, [False]])
+        edges = np.flatnonzero(np.diff(above.astype(np.int8)))
+        for start, stop in zip(edges[::2], edges[1::2]):
+            clusters.append((int(start), int(stop),
+                             float(np.sum(stat[start:stop]))))
+    return sorted(clusters)
+
+
+def _permutation_task(x, n_a, size, seed_seq, stat, tail, threshold,
+                      observed):
+    """
+One batch of permutations.
+    @return: ((time,) counts of permuted statistics at least as extreme as
+    observed, (size,) max statistic, (size,) max cluster mass or None)
+    """
+    rng = np.random.default_rng(seed_seq)
+    n = len(x)
+    totals = (x.sum(axis=0), (x ** 2).sum(axis=0))
+    # each row a random permutation of n_a ones and n - n_a zeros
+    labels = (np.argsort(rng.random((size, n)), axis=1) < n_a).astype(
+        np.float64)
+    perm = group_stat(labels @ x, labels @ (x ** 2), totals, n_a, n - n_a,
+                      stat)
+    extreme = tail_stat(perm, tail)
+    counts = np.sum(extreme >= observed, axis=0)
+    max_stat = np.max(extreme, axis=1)
+    mass = None
+    if threshold is not None:
+        mass = max_cluster_mass(perm, threshold, tail)
+    return counts, max_stat, mass
+
+
+@profiling.profiled()
+def permutation_test(a, b, n_perm=10000, stat='t', tail=0, threshold=None,
+                     seed=None, batch_size=500, executor=None):
+    """
+Permutation test of group a vs group b at each time point, subjects'
+group labels are shuffled. Subjects with NaN values are left out.
+    @param a: (subjects of a, time) np array of per-subject signals
+    @param b: (subjects of b, time) np array of per-subject signals
+    @param n_perm: number of permutations
+    @param stat: one of STATISTICS
+    @param tail: 0 two-sided, 1 for a > b, -1 for a < b
+    @param threshold: cluster forming threshold (in stat units, e.g 2.0 for
+    't'), None for no cluster correction
+    @param seed: seed of the random generator
+    @param batch_size: number of permutations per batch, memory is about
+    batch_size x time x 5 floats
+    @param executor: ShardExecutor to run the batches on, None to run them
+    in this process
+    @return: PermutationResult
+    """
+    if stat not in STATISTICS:
+        raise ValueError(f"unknown statistic: {stat}, "
+                         f"allowed are {STATISTICS}")
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    a = a[~np.any(np.isnan(a), axis=1)]
+    b = b[~np.any(np.isnan(b), axis=1)]
+    n_a, n_b = len(a), len(b)
+    if n_a < 2 or n_b < 2:
+        raise ValueError(f"too few subjects to compare: {n_a} vs {n_b}")
+    x = np.concatenate([a, b])
+    # centered, the statistics are shift invariant and the sums of squares
+    # lose less precision
+    x -= x.mean(axis=0)
+    totals = (x.sum(axis=0), (x ** 2).sum(axis=0))
+    observed = group_stat(x[:n_a].sum(axis=0), (x[:n_a] ** 2).sum(axis=0),
+                          totals, n_a, n_b, stat)
+    extreme = tail_stat(observed, tail)
+
+    sizes = [min(batch_size, n_perm - i) for i in range(0, n_perm, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    n = len(sizes)
+    args = ([x] * n, [n_a] * n, sizes, seeds, [stat] * n, [tail] * n,
+            [threshold] * n, [extreme] * n)
+    if executor is None:
+        parts = list(map(_permutation_task, *args))
+    else:
+        parts = executor.map(_permutation_task, *args)
+
+    counts = np.sum([part[0] for part in parts], axis=0)
+    null_max = np.concatenate([part[1] for part in parts])
+    p = (counts + 1) / (n_perm + 1)
+    p_max = (np.sum(null_max[:, None] >= extreme, axis=0) + 1) / (n_perm + 1)
+    clusters, null_mass = [], None
+    if threshold is not None:
+        null_mass = np.concatenate([part[2] for part in parts])
+        for start, stop, mass in find_clusters(observed, threshold, tail):
+            n_extreme = np.sum(null_mass >= abs(mass))
+            p_cluster = float(n_extreme + 1) / (n_perm + 1)
+            clusters.append(Cluster(start, stop, mass, p_cluster))
+    return PermutationResult(observed, p, p_max, clusters, null_mass, n_perm,
+                             (n_a, n_b))
+
+
+def group_comparison(group_a, group_b, trials, blocks, data=mat_data,
+                     executor=None, **kwargs):
+    """
+Permutation test of two groups' per-subject signals, as GroupSignal fits
+them (ERPs for trial / block ranges, single epochs otherwise).
+    @param group_a: group name, e.g "Control"
+    @param group_b: group name, e.g "ASD"
+    @param trials: int or (start, end), see trial_block_index
+    @param blocks: int or (start, end), see trial_block_index
+    @param data: data object
+    @param executor: ShardExecutor of data's s2, fits and permutations are
+    then run over its processes
+    @param kwargs: see permutation_test
+    @return: PermutationResult
+    """
+    index = subject_index(data)
+    trial, block, avg_over = trial_block_index(trials, blocks)
+    fits = []
+    for group in (group_a, group_b):
+        rows = index.group(group)
+        if executor is None:
+            valid = epoch_index(data).mask(rows, trial, block)
+            fits.append(subject_fits(data['s2'], rows, trial, block,
+                                     avg_over, valid=valid)[0])
+        else:
+            fits.append(executor.subject_fits(rows, trials, blocks)[0])
+    return permutation_test(*fits, executor=executor, **kwargs)
@@ -0,0 +1,127 @@
+"""
+Synthetic EEG study, laid out like the real one: a .mat file with the
+structure MatIngest expects, an E-Prime folder of session .txt files, the
+patterns and id map JSON files, and a CONFIG.yaml pointing at all of them.
+
+    python synthetic.py <folder> [--subjects 20] [--time 1000] ...
+"""
+import argparse
+import json
+import numpy as np
+import os
+import scipy.io as sio
+import yaml
+
+DATA_ATTR_NAME = "Data_All"
+GROUPS = ("Control", "ASD")
+# E-Prime RT's per session, as EPrime.extract_trial_rts expects
+N_RTS = 340
+EPRIME_PATTERNS = {
+    "meta": {"Name": r"(?<=Subject: )\S+"},
+    "data": {"trial_rt": r"(?<=Target\.RT: )\d+",
+             "trial_response_button": r"(?<=Target\.RESP: )[^\r\n]*"}}
+
+
+def make_s2(n_subjects, n_time, n_trials, n_blocks, nan_rate, rng,
+            t_min=-500, t_max=1500):
+    """
+
+    @return: (s2, time, group): s2 tensor (subjects, time, trials, blocks)
+    of noisy N100/P200 ERPs, with a nan_rate fraction of all-NaN epochs
+    """
+    time = np.linspace(t_min, t_max, n_time)
+    group = np.array([GROUPS[i % len(GROUPS)] for i in range(n_subjects)],
+                     dtype=object)
+    erp = (-4 * np.exp(-((time - 100) / 25) ** 2) +
+           5 * np.exp(-((time - 200) / 40) ** 2))
+    amp = np.where(group == GROUPS[0], 1.0, 0.7)
+    s2 = (amp[:, None, None, None] * erp[None, :, None, None] *
+          rng.uniform(0.5, 1.5, (n_subjects, 1, n_trials, n_blocks)) +
+          rng.normal(0, 2, (n_subjects, n_time, n_trials, n_blocks)))
+    empty = rng.random((n_subjects, n_trials, n_blocks)) < nan_rate
+    s2.transpose(0, 2, 3, 1)[empty] = np.nan
+    return s2, time, group
+
+
+def eprime_text(name, n_rts, rng, no_response_rate=0.1):
+    lines = ["*** Header Start ***", "VersionPersist: 1",
+             f"Subject: {name}", "Session: 1", "*** Header End ***"]
+    for k in range(n_rts):
+        resp = "" if rng.random() < no_response_rate else "1"
+        rt = int(rng.integers(200, 900)) if resp else 0
+        lines += ["\t*** LogFrame Start ***", f"\tTrial: {k + 1}",
+                  f"\tTarget.RT: {rt}", f"\tTarget.RESP: {resp}",
+                  "\t*** LogFrame End ***"]
+    return "\r\n".join(lines)
+
+
+def make_dataset(path, n_subjects=20, n_time=1000, n_trials=10, n_blocks=34,
+                 nan_rate=0.02, behave_rate=0.9, seed=0):
+    """
+Write a synthetic study into path.
+    @param path: destination folder
+    @param n_subjects: number of subjects
+    @param n_time: number of time points per epoch
+    @param n_trials: number of trials per block
+    @param n_blocks: number of blocks
+    @param nan_rate: fraction of all-NaN epochs
+    @param behave_rate: fraction of subjects with an E-Prime session file
+    @param seed: seed of the random generator
+    @return: path of the written CONFIG.yaml
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    s2, time, group = make_s2(n_subjects, n_time, n_trials, n_blocks,
+                              nan_rate, rng)
+    subjects = np.array([f"S{i:03d}" for i in range(n_subjects)],
+                        dtype=object)
+    mat_filename = os.path.join(path, "data.mat")
+    sio.savemat(mat_filename, {DATA_ATTR_NAME: {
+        "s2": s2, "subjects": subjects, "group": group, "time": time}})
+
+    behave_path = os.path.join(path, "behave")
+    os.makedirs(behave_path, exist_ok=True)
+    id_map = {}
+    for i, name in enumerate(subjects):
+        if rng.random() >= behave_rate:
+            continue
+        if i % 7 == 3:  # some sessions are logged under another id
+            id_map[f"X{i:03d}"] = name
+            name = f"X{i:03d}"
+        with open(os.path.join(behave_path, f"session_{i:03d}.txt"),
+                  'wb') as f:
+            # E-Prime writes UTF-16LE with a BOM
+            f.write(eprime_text(name, N_RTS, rng).encode('utf-16'))
+
+    config = {"data_attr_name": DATA_ATTR_NAME,
+              "mat_filename": mat_filename,
+              "behave_path": behave_path,
+              "eprime_patterns": os.path.join(path, "eprime_patterns.json"),
+              "id_map": os.path.join(path, "id_map.json"),
+              "cache_dir": os.path.join(path, "cache")}
+    with open(config["eprime_patterns"], 'w') as jf:
+        json.dump(EPRIME_PATTERNS, jf, indent=2)
+    with open(config["id_map"], 'w') as jf:
+        json.dump(id_map, jf, indent=2)
+    config_filename = os.path.join(path, "CONFIG.yaml")
+    with open(config_filename, 'w') as f:
+        yaml.dump(config, f)
+    return config_filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('path')
+    parser.add_argument('--subjects', type=int, default=20)
+    parser.add_argument('--time', type=int, default=1000)
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--blocks', type=int, default=34)
+    parser.add_argument('--nan-rate', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(make_dataset(args.path, args.subjects, args.time, args.trials,
+                       args.blocks, args.nan_rate, seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,32 +3,75 @@ from data_ingestion import mat_data as data
 import numpy as np
 import plot
 
-# TODO: append id to sub labels
-sub_name_dropdown_labels = list(zip(data['group'] + " " + data['subjects'], data['subjects']))
-sub_name_dropdown = ipywidgets.Dropdown(options=sub_name_dropdown_labels)
-group_name_dropdown = ipywidgets.Dropdown(options=np.unique(data['group']))
+# options are filled by load_options, so importing doesn't load the data
+sub_name_dropdown = ipywidgets.Dropdown()
+group_name_dropdown = ipywidgets.Dropdown()
 
 
+def load_options(data=data):
+    """
+Fill the options of the data dependent widgets (loads the data on first use)
+    @param data: data object
+    """
+    if not sub_name_dropdown.options:
+        # TODO: append id to sub labels
+        sub_name_dropdown.options = list(zip(
+            data['group'] + " " + data['subjects'], data['subjects']))
+    if not group_name_dropdown.options:
+        group_name_dropdown.options = np.unique(data['group'])
 
-block_start_slider = ipywidgets.SelectionSlider(
-    options=list(range(1,34+1)),
-    description='block',
-    value=1,
-    layout={'width': '500px'})
 
-block_end_slider=ipywidgets.SelectionSlider(options=[False]+list(range(1,34+1)),
-                          description='block end',
-                          value=False,
-                          layout={'width': '500px'})
 
-trial_start_slider = ipywidgets.SelectionSlider(
-    options=list(range(1,10+1)),
-    description='trial',
-    value=1)
+def range_sliders():
+    """
+New trial and block range sliders, e.g for a dashboard observing its own
+    @return: dict of query argument -> slider, trial_start, block_start,
+    trial_end, block_end
+    """
+    block_start = ipywidgets.SelectionSlider(
+        options=list(range(1,34+1)),
+        description='block',
+        value=1,
+        layout={'width': '500px'})
 
-trial_end_slider=ipywidgets.SelectionSlider(options=[False]+list(range(1,10+1)),
-                          description='trial end',
-                          value=False)
+    block_end=ipywidgets.SelectionSlider(options=[False]+list(range(1,34+1)),
+                              description='block end',
+                              value=False,
+                              layout={'width': '500px'})
+
+    trial_start = ipywidgets.SelectionSlider(
+        options=list(range(1,10+1)),
+        description='trial',
+        value=1)
+
+    trial_end=ipywidgets.SelectionSlider(options=[False]+list(range(1,10+1)),
+                              description='trial end',
+                              value=False)
+    return dict(trial_start=trial_start, block_start=block_start,
+                trial_end=trial_end, block_end=block_end)
+
+
+def query_widgets(dropdown):
+    """
+New widgets of a dashboard's query (loads the data on first use), so that
+the dashboard's board watches only its own
+    @param dropdown: name of the query's dropdown, 'name' (subjects) or
+    'group'
+    @return: dict of query argument -> widget
+    """
+    load_options()
+    source = {'name': sub_name_dropdown,
+              'group': group_name_dropdown}[dropdown]
+    query = {dropdown: ipywidgets.Dropdown(options=source.options)}
+    query.update(range_sliders())
+    return query
+
+
+_sliders = range_sliders()
+block_start_slider = _sliders['block_start']
+block_end_slider = _sliders['block_end']
+trial_start_slider = _sliders['trial_start']
+trial_end_slider = _sliders['trial_end']
 
 lighter_slider = ipywidgets.IntSlider(value=4, min=1, max=5)
 